@@ -23,6 +23,11 @@ if [ ! -e "${SLICER_DOWNLOAD_SERVER_CONF}" ]; then
   echo "SLICER_DOWNLOAD_SERVER_CONF set to an nonexistent file: ${SLICER_DOWNLOAD_SERVER_CONF}"
   exit 99
 fi
+if [[ -n "${SLICER_DOWNLOAD_EXPORT_DIR}" && -z "${SLICER_DOWNLOAD_HOSTNAME}" ]]; then
+  echo "SLICER_DOWNLOAD_HOSTNAME is required to export static files into ${SLICER_DOWNLOAD_EXPORT_DIR}"
+  exit 99
+fi
+export SLICER_DOWNLOAD_HOSTNAME
 
 # Set variables
 SLICER_DOWNLOAD_DB_FALLBACK=$(PYTHONPATH=${ROOT_DIR} ${PYTHON_EXECUTABLE} -c "import slicer_download_server as sds; print(sds.app.config['DB_FALLBACK'])")
@@ -38,9 +43,17 @@ echo "  SLICER_DOWNLOAD_DEBUG      : ${SLICER_DOWNLOAD_DEBUG}"
 echo "  SLICER_DOWNLOAD_DB_FALLBACK: ${SLICER_DOWNLOAD_DB_FALLBACK}"
 echo "  SLICER_DOWNLOAD_DB_FILE    : ${SLICER_DOWNLOAD_DB_FILE}"
 echo "  SLICER_DOWNLOAD_SERVER_API : ${SLICER_DOWNLOAD_SERVER_API}"
+echo "  SLICER_DOWNLOAD_EXPORT_DIR : ${SLICER_DOWNLOAD_EXPORT_DIR}"
+echo "  SLICER_DOWNLOAD_HOSTNAME   : ${SLICER_DOWNLOAD_HOSTNAME}"
 echo
 echo "[slicer_getbuildinfo] Using these directories"
 echo "  ROOT_DIR       : ${ROOT_DIR}"
 
 echo
 PYTHONPATH=${ROOT_DIR} "${PYTHON_EXECUTABLE}" "${ROOT_DIR}/etc/slicer_getbuildinfo" ${SLICER_DOWNLOAD_DB_FILE}
+
+# Export static files served by the front web server
+if [[ -n "${SLICER_DOWNLOAD_EXPORT_DIR}" ]]; then
+  echo
+  PYTHONPATH=${ROOT_DIR} "${PYTHON_EXECUTABLE}" "${ROOT_DIR}/etc/slicer_export" ${SLICER_DOWNLOAD_EXPORT_DIR}
+fi
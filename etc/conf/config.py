@@ -7,3 +7,7 @@ from config_utils import toBool  # noqa: E402
 
 DB_FALLBACK = toBool(os.environ.get("SLICER_DOWNLOAD_DB_FALLBACK", False))
 DEBUG = toBool(os.environ.get("SLICER_DOWNLOAD_DEBUG", False))
+QUERY_ENGINE = os.environ.get("SLICER_DOWNLOAD_QUERY_ENGINE", "memory")
+SHARED_SNAPSHOT = toBool(os.environ.get("SLICER_DOWNLOAD_SHARED_SNAPSHOT", False))
+SERVER_TIMING = toBool(os.environ.get("SLICER_DOWNLOAD_SERVER_TIMING", False))
+DEBUG_TOKEN = os.environ.get("SLICER_DOWNLOAD_DEBUG_TOKEN")
@@ -0,0 +1,311 @@
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import resource
+import runpy
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..', '..'))
+
+ENDPOINTS = ('/', '/find', '/findall', '/download')
+
+SERVER_APIS = {
+    'midas': 'Midas_v1',
+    'girder': 'Girder_v1'
+}
+
+# Number of packages generated for each operating system and day
+PACKAGES_PER_DAY = 2
+
+# Fraction of the generated packages associated with a release
+RELEASE_FRACTION = 0.05
+
+FIRST_DAY = datetime.datetime(2010, 1, 1)
+
+OPERATING_SYSTEMS = ('win', 'macosx', 'linux')
+
+
+def generateRecords(api, count, seed):
+    """Yield ``(item_id, revision, checkout_date, build_date, record)`` rows for
+    ``count`` synthetic records of server API ``api`` (``midas`` or ``girder``).
+
+    Records are generated day by day, each day having :const:`PACKAGES_PER_DAY`
+    packages for each operating system.
+    """
+    rng = random.Random(seed)
+    revision = 10000
+    for index in range(count):
+        day, position = divmod(index, PACKAGES_PER_DAY * len(OPERATING_SYSTEMS))
+        if position == 0:
+            revision += rng.randint(1, 5)
+        operatingSystem = OPERATING_SYSTEMS[position % len(OPERATING_SYSTEMS)]
+        build_date = (FIRST_DAY + datetime.timedelta(days=day, minutes=rng.randint(0, 1800))).strftime(
+            '%Y-%m-%d %H:%M:%S')
+        release = ''
+        if rng.random() < RELEASE_FRACTION:
+            release = '{0}.{1}.{2}'.format(4 + day // 3650, day // 100 % 100, rng.randint(0, 3))
+        version = release or '{0}.{1}.0'.format(4 + day // 3650, day // 100 % 100 + 1)
+        itemId = 1000 + index
+
+        if api == 'midas':
+            record = {
+                'item_id': str(itemId), 'revision': str(revision), 'checkoutdate': build_date,
+                'date_creation': build_date, 'os': operatingSystem, 'arch': 'amd64', 'codebase': 'Slicer4',
+                'package': 'installer', 'productname': 'Slicer', 'release': release,
+                'submissiontype': 'nightly' if rng.random() < 0.9 else 'experimental',
+                'name': 'Slicer-{0}-{1}-{2}-amd64'.format(version, build_date[:10], operatingSystem),
+                'bitstreams': [{'bitstream_id': str(itemId * 10), 'size': rng.randint(10 ** 8, 10 ** 9),
+                                'md5': '%032x' % rng.getrandbits(128), 'name': 'Slicer.zip'}]
+            }
+            yield itemId, revision, build_date, build_date, json.dumps(record)
+        else:
+            itemId = '%024x' % itemId
+            created = build_date.replace(' ', 'T') + '.000Z'
+            meta = {'os': operatingSystem, 'arch': 'amd64', 'revision': str(revision), 'build_date': created,
+                    'baseName': 'Slicer', 'version': '{0}-{1}'.format(version, build_date[:10])}
+            if release:
+                meta['release'] = release
+            record = {'_id': itemId, 'name': 'Slicer-{0}-{1}'.format(version, operatingSystem),
+                      'size': rng.randint(10 ** 8, 10 ** 9), 'created': created, 'meta': meta}
+            yield itemId, revision, created, created, json.dumps(record)
+
+
+def generateDatabase(filepath, api, count, seed):
+    """Create database ``filepath`` with a ``_`` table holding ``count`` synthetic records.
+
+    The database is only created if it does not exist.
+    """
+    if os.path.exists(filepath):
+        return
+    tmp_filepath = filepath + '.tmp'
+    if os.path.exists(tmp_filepath):
+        os.unlink(tmp_filepath)
+    primary_key_type = "INTEGER" if api == 'midas' else "TEXT"
+    with sqlite3.connect(tmp_filepath) as db:
+        db.execute('''create table if not exists
+        _(item_id {primary_key_type} primary key,
+                    revision INTEGER,
+                    checkout_date TEXT,
+                    build_date TEXT,
+                    record TEXT)'''.format(primary_key_type=primary_key_type))
+        db.executemany('insert into _ values(?,?,?,?,?)', generateRecords(api, count, seed))
+    os.replace(tmp_filepath, filepath)
+
+
+def generateQueries(mode, count, seed, dayCount, firstRevision, lastRevision, revisions, versions):
+    """Return list of ``count`` query argument dictionaries for ``mode``."""
+    rng = random.Random(seed)
+
+    def randomDate():
+        return (FIRST_DAY + datetime.timedelta(days=rng.randint(0, dayCount))).strftime('%Y-%m-%d')
+
+    values = {
+        'revision': lambda: rng.choice(revisions),
+        'closest-revision': lambda: str(rng.randint(firstRevision, lastRevision)),
+        'version': lambda: rng.choice(versions),
+        'checkout-date': randomDate,
+        'date': randomDate
+    }
+    queries = []
+    for _ in range(count):
+        args = {'os': rng.choice(OPERATING_SYSTEMS), 'stability': rng.choice(('release', 'nightly', 'any'))}
+        args[mode] = values[mode]()
+        if rng.random() < 0.1:
+            args['offset'] = str(rng.randint(-3, 3))
+        queries.append(args)
+    return queries
+
+
+def residentSetSize():
+    """Return resident set size of the current process in bytes or ``None``."""
+    try:
+        with open('/proc/self/statm') as fp:
+            return int(fp.read().split()[1]) * resource.getpagesize()
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def percentiles(durations):
+    durations = sorted(durations)
+
+    def percentile(fraction):
+        return durations[min(len(durations) - 1, int(fraction * len(durations)))]
+
+    return {
+        'count': len(durations),
+        'mean': statistics.mean(durations),
+        'p50': percentile(0.50),
+        'p90': percentile(0.90),
+        'p99': percentile(0.99),
+        'max': durations[-1]
+    }
+
+
+def runCase(api, database_filepath, engine, requestCount, seed):
+    """Load ``database_filepath`` and time the requests sent to each endpoint for each mode.
+
+    This function is expected to run in a dedicated process (see :func:`benchmarkCase`):
+    the server API is selected when ``slicer_download_server`` is imported.
+    """
+    os.environ['SLICER_DOWNLOAD_SERVER_API'] = SERVER_APIS[api]
+    os.environ.setdefault('SLICER_DOWNLOAD_SERVER_CONF', os.path.join(ROOT_DIR, 'etc', 'conf', 'config.py'))
+    sys.path.insert(0, ROOT_DIR)
+    import slicer_download_server as sds
+
+    if engine == 'sql':
+        # Add the indexed columns expected by the sql query engine (see slicer_getbuildinfo)
+        getbuildinfo = runpy.run_path(os.path.join(ROOT_DIR, 'etc', 'slicer_getbuildinfo', '__main__.py'))
+        with sqlite3.connect(database_filepath) as db:
+            getbuildinfo['updateIndexedColumns'](db, sds.SERVER_API_ADAPTER)
+
+    sds.app.config['DB_FILE'] = database_filepath
+    sds.app.config['QUERY_ENGINE'] = engine
+    sds.app.config['SHARED_SNAPSHOT'] = False
+    client = sds.app.test_client()
+
+    with sqlite3.connect(database_filepath) as db:
+        recordCount, firstRevision, lastRevision = db.execute(
+            'select count(1), min(revision), max(revision) from _').fetchone()
+        records = [json.loads(record) for record, in db.execute('select record from _ order by random() limit 1000')]
+    revisions = sorted({str(sds.getRecordField(record, 'revision')) for record in records})
+    versions = sorted({sds.getVersion(record) for record in records} - {None})
+    dayCount = recordCount // (PACKAGES_PER_DAY * len(OPERATING_SYSTEMS))
+
+    result = {
+        'api': api,
+        'records': recordCount,
+        'engine': engine,
+        'rss_before_load': residentSetSize()
+    }
+    startTime = time.perf_counter()
+    status = client.get('/find', query_string={'os': 'win'}).status_code
+    result['load_seconds'] = time.perf_counter() - startTime
+    result['load_status'] = status
+    result['rss_after_load'] = residentSetSize()
+
+    result['endpoints'] = {}
+    for endpoint in ENDPOINTS:
+        result['endpoints'][endpoint] = endpointResults = {}
+        for mode in sds.MODE_CHOICES:
+            if mode not in sds.getSupportedMode():
+                endpointResults[mode] = {'unsupported': True}
+                continue
+            queries = generateQueries(
+                mode, requestCount, seed, dayCount, firstRevision, lastRevision, revisions, versions)
+            durations = []
+            statuses = {}
+            for args in queries:
+                if endpoint in ('/', '/findall'):
+                    args = {name: value for name, value in args.items() if name not in ('os', 'stability')}
+                startTime = time.perf_counter()
+                response = client.get(endpoint, query_string=args)
+                durations.append(time.perf_counter() - startTime)
+                statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+            endpointResults[mode] = dict(percentiles(durations), statuses=statuses)
+
+    result['rss_after_requests'] = residentSetSize()
+    result['max_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    result['resolution_cache'] = sds.RESOLUTION_CACHE.stats()
+    return result
+
+
+def benchmarkCase(api, database_filepath, engine, requestCount, seed):
+    """Run :func:`runCase` in a new process and return its results.
+
+    Running each case in a new process isolates the memory usage and allows
+    selecting the server API.
+    """
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_filepath = os.path.join(tmp_dir, 'case.json')
+        subprocess.run([
+            sys.executable, os.path.dirname(os.path.abspath(__file__)),
+            '--case', api, database_filepath,
+            '--engine', engine, '--requests', str(requestCount), '--seed', str(seed),
+            '--output', output_filepath
+        ], stdout=subprocess.DEVNULL, check=True)
+        with open(output_filepath) as fp:
+            return json.load(fp)
+
+
+def compareResults(baseline, results):
+    """Print the ratio of the median latencies of ``results`` to the ``baseline`` ones."""
+    baselineCases = {(case['api'], case['records'], case['engine']): case for case in baseline['results']}
+    for case in results['results']:
+        previous = baselineCases.get((case['api'], case['records'], case['engine']))
+        if previous is None:
+            continue
+        print("{0} {1} records ({2}): load {3:.2f}x".format(
+            case['api'], case['records'], case['engine'], case['load_seconds'] / previous['load_seconds']))
+        for endpoint, modes in case['endpoints'].items():
+            for mode, stats in modes.items():
+                previousStats = previous['endpoints'].get(endpoint, {}).get(mode, {})
+                if 'p50' in stats and previousStats.get('p50'):
+                    print("  {0:<10} {1:<18} p50 {2:.2f}x  p99 {3:.2f}x".format(
+                        endpoint, mode, stats['p50'] / previousStats['p50'], stats['p99'] / previousStats['p99']))
+
+
+def main():
+    argparser = argparse.ArgumentParser(description='Benchmark slicer_download_server endpoints.')
+    argparser.add_argument('--api', choices=sorted(SERVER_APIS), action='append',
+                           help="server API of the generated records (default: all)")
+    argparser.add_argument('--sizes', default='10000,100000',
+                           help="comma separated numbers of generated records (default: %(default)s)")
+    argparser.add_argument('--engine', default='memory', choices=('memory', 'sql'),
+                           help="server query engine (default: %(default)s)")
+    argparser.add_argument('--requests', type=int, default=200,
+                           help="number of requests per endpoint and mode (default: %(default)s)")
+    argparser.add_argument('--seed', type=int, default=1, help="random seed (default: %(default)s)")
+    argparser.add_argument('--workdir', default=os.path.join(ROOT_DIR, 'tmp', 'benchmark'),
+                           help="directory of the generated databases (default: %(default)s)")
+    argparser.add_argument('--output', required=True, help="JSON results file")
+    argparser.add_argument('--compare', help="JSON results file of a previous run")
+    argparser.add_argument('--case', nargs=2, metavar=('API', 'DB_FILE'), help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+
+    if args.case:
+        api, database_filepath = args.case
+        with open(args.output, 'w') as fp:
+            json.dump(runCase(api, database_filepath, args.engine, args.requests, args.seed), fp)
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    results = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': sys.version,
+        'platform': platform.platform(),
+        'arguments': vars(args),
+        'results': []
+    }
+
+    for api in args.api or sorted(SERVER_APIS):
+        for size in (int(size) for size in args.sizes.split(',')):
+            database_filepath = os.path.join(
+                args.workdir, 'slicer-{0}-{1}-{2}-records.sqlite'.format(api, size, args.seed))
+            print("Generating {0}".format(database_filepath))
+            generateDatabase(database_filepath, api, size, args.seed)
+
+            print("Benchmarking {0} {1} records ({2})".format(api, size, args.engine))
+            result = benchmarkCase(api, database_filepath, args.engine, args.requests, args.seed)
+            print("  loaded in {0:.3f}s, {1} MB".format(
+                result['load_seconds'], (result['rss_after_load'] or 0) // 2 ** 20))
+            results['results'].append(result)
+
+    with open(args.output, 'w') as fp:
+        json.dump(results, fp, indent=2)
+    print("Saved {0}".format(args.output))
+
+    if args.compare:
+        with open(args.compare) as fp:
+            compareResults(json.load(fp), results)
+
+
+if __name__ == '__main__':
+    main()
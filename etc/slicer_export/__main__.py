@@ -0,0 +1,141 @@
+import os
+import sys
+import textwrap
+
+import flask
+from flask import json
+
+from slicer_download_server import (
+    app,
+    dbFilePath,
+    getBestMatching,
+    getDownloadStatsURL,
+    getMode,
+    getRecordIndexFromDb,
+    recordsMatchingAllOSAndStability,
+    STABILITY_CHOICES,
+    SUPPORTED_OS_CHOICES
+)
+from slicer_download_server.atomicfile import atomicWrite
+
+# Name of the files written in the output directory
+FINDALL_FILENAME = 'findall.json'
+DOWNLOAD_PAGE_FILENAME = 'download.html'
+DOWNLOAD_MAP_FILENAME = 'download.map'
+
+DOWNLOAD_MAP_HEADER = """\
+# Generated by slicer_export from {dbfile} (version {version})
+#
+# Associate the query string of common /download requests with the matching
+# local bitstream URL. Other requests should be forwarded to the server.
+#
+# Example of nginx configuration:
+#
+#   map $args $slicer_download_redirect {{
+#       default "";
+#       include {filename};
+#   }}
+#
+#   location = /download {{
+#       if ($slicer_download_redirect) {{
+#           return 302 $slicer_download_redirect;
+#       }}
+#       include uwsgi_params;
+#       uwsgi_pass slicer_download;
+#   }}
+#
+"""
+
+
+def writeFile(filepath, content):
+    """Write ``content`` into ``filepath``.
+
+    The web server never reads a partially written file (see
+    :func:`slicer_download_server.atomicfile.atomicWrite`).
+    """
+    with atomicWrite(filepath) as fp:
+        fp.write(content)
+
+
+def downloadMapEntries(recordIndex):
+    """Return list of ``(query_string, download_url)`` for the ``/download`` requests
+    only specifying ``os`` and optionally ``stability``.
+
+    Query strings are listed with both parameter orders. Requests without matching
+    record are not listed, they are answered by the server.
+
+    See :func:`slicer_download_server.getBestMatching`.
+    """
+    modeName, value = getMode({})
+    entries = []
+    for operatingSystem in SUPPORTED_OS_CHOICES:
+        for stability in STABILITY_CHOICES:
+            record = getBestMatching(recordIndex, operatingSystem, stability, modeName, value, 0)
+            if not record:
+                continue
+            queryStrings = [
+                'os={0}&stability={1}'.format(operatingSystem, stability),
+                'stability={1}&os={0}'.format(operatingSystem, stability)
+            ]
+            if stability == 'release':  # default stability
+                queryStrings.append('os={0}'.format(operatingSystem))
+            entries.extend((queryString, record['download_url']) for queryString in queryStrings)
+    return entries
+
+
+def main(output_dir, hostname):
+    """Export the static files into ``output_dir``.
+
+    ``hostname`` is the URL of the server the exported pages are served from, links
+    of the download page start with it (see :func:`slicer_download_server.getDownloadStatsURL`).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+
+    with app.test_request_context('/', base_url=hostname):
+        recordIndex = getRecordIndexFromDb()
+
+        allRecords, error_message, error_code = recordsMatchingAllOSAndStability(recordIndex)
+        if not allRecords:
+            print("Failed to retrieve records: {0}".format(error_message), file=sys.stderr)
+            sys.exit(1)
+
+        writeFile(os.path.join(output_dir, FINDALL_FILENAME), json.dumps(allRecords))
+
+        writeFile(os.path.join(output_dir, DOWNLOAD_PAGE_FILENAME), flask.render_template(
+            'download.html', R=allRecords, download_stats_url=getDownloadStatsURL()))
+
+        mapFilepath = os.path.join(output_dir, DOWNLOAD_MAP_FILENAME)
+        header = DOWNLOAD_MAP_HEADER.format(
+            dbfile=dbFilePath(),
+            version=recordIndex.publishedVersion,
+            filename=mapFilepath)
+        writeFile(mapFilepath, header + ''.join(
+            '"{0}" {1};\n'.format(queryString, downloadURL)
+            for queryString, downloadURL in downloadMapEntries(recordIndex)))
+
+    print("Saved {0}, {1} and {2} into {3}".format(
+        FINDALL_FILENAME, DOWNLOAD_PAGE_FILENAME, DOWNLOAD_MAP_FILENAME, output_dir))
+
+
+if __name__ == '__main__':
+    hostname = os.environ.get('SLICER_DOWNLOAD_HOSTNAME')
+    if len(sys.argv) != 2 or not hostname:
+        print(textwrap.dedent("""
+        Usage: SLICER_DOWNLOAD_HOSTNAME=URL %s OUTPUT_DIR
+
+          Export the responses to the most common requests as static files:
+
+            findall.json   /findall JSON document
+            download.html  rendered download page
+            download.map   nginx map associating /download query strings
+                           with the matching local bitstream URL
+
+          These files may then be served by the front web server.
+
+          SLICER_DOWNLOAD_HOSTNAME must be set to the URL of the server the
+          files are served from (e.g. https://download.slicer.org).
+
+        """ % sys.argv[0]), file=sys.stderr)
+        sys.exit(1)
+
+    main(sys.argv[1], hostname)
@@ -1,15 +1,50 @@
+import datetime
+import hashlib
+import itertools
 import json
+import os
+import shutil
 import sqlite3
 import sys
 import textwrap
 
 from slicer_download import (
     getServerAPI,
+    getServerAPIAdapter,
     ServerAPI,
-    getRecordsFromURL,
-    getServerAPIUrl
+    iterRecordsFromURL,
+    getServerAPIUrl,
+    NORMALIZED_COLUMNS,
+    NORMALIZED_SCHEMA_VERSION
 )
 
+# Columns derived from the raw record allowing the server to answer queries
+# using SQL statements (see QUERY_ENGINE server configuration entry)
+INDEXED_COLUMNS = ('os', 'stability', 'submissiontype', 'version')
+
+# Number of records written at once. Records are streamed from the server API
+# and written by chunks, bounding the memory used (see insertRecords)
+INSERT_CHUNK_SIZE = 500
+
+# Column of the "_" table storing the creation date of the records. Only the
+# records created on or after the newest one are retrieved (see iterRecordsFromURL)
+CREATION_DATE_COLUMN = {
+    ServerAPI.Midas_v1: 'build_date',  # date_creation
+    ServerAPI.Girder_v1: 'checkout_date'  # created
+}
+
+# Records modified upstream are only updated when all the records are downloaded,
+# which is done if the last full update is older than this interval (see updateDb)
+FULL_UPDATE_INTERVAL = datetime.timedelta(days=1)
+
+# Records created up to this interval before the newest stored record are downloaded
+# again, packages listed late by the server API are then not missed (see fetchCutoffDate)
+FETCH_OVERLAP = datetime.timedelta(days=2)
+
+# Number of entries kept in the change_log table. The server loads all the records
+# again if the rows changed since its previous load are no longer all listed.
+CHANGE_LOG_SIZE = 100000
+
 
 def midasRecordToDb(r):
     try:
@@ -30,48 +65,414 @@ def girderRecordToDb(r):
             json.dumps(r)]
 
 
-def recordToDb(r):
-    return {
+def indexedColumnsToDb(r, adapter):
+    """Return values associated with :const:`INDEXED_COLUMNS`."""
+    return [adapter.getField(r, 'os'),
+            adapter.getStability(r),
+            adapter.getField(r, 'submissiontype'),
+            adapter.getVersion(r) or '']
+
+
+def recordToDb(r, adapter):
+    row = {
         ServerAPI.Midas_v1: midasRecordToDb,
         ServerAPI.Girder_v1: girderRecordToDb,
-    }[getServerAPI()](r)
+    }[adapter.serverAPI](r)
+    if row is None:
+        return None
+    return row + indexedColumnsToDb(r, adapter)
+
+
+def updateIndexedColumns(db, adapter):
+    """Add :const:`INDEXED_COLUMNS` to a table created by an earlier version of this
+    script, fill them and create the associated indexes."""
+    columns = [row[1] for row in db.execute('pragma table_info(_)')]
+    for column in INDEXED_COLUMNS:
+        if column not in columns:
+            db.execute('alter table _ add column {0} TEXT'.format(column))
+
+    rows = db.execute('select item_id, record from _ where os is null').fetchall()
+    if rows:
+        print("Updating indexed columns of {0} records".format(len(rows)))
+        db.executemany('''update _ set os=?, stability=?, submissiontype=?, version=? where item_id=?''',
+                       [indexedColumnsToDb(json.loads(record), adapter) + [item_id] for item_id, record in rows])
+
+    db.execute('''create index if not exists _os_revision_idx
+        on _(os, revision desc, build_date desc)''')
+    db.execute('''create index if not exists _os_stability_revision_idx
+        on _(os, stability, revision desc, build_date desc)''')
+    db.execute('''create index if not exists _os_submissiontype_revision_idx
+        on _(os, submissiontype, revision desc, build_date desc)''')
+    db.execute('''create index if not exists _version_idx on _(version)''')
+
+
+def normalizedRecordToDb(r, adapter):
+    """Return row of the ``packages`` table associated with ``r``.
+
+    See :const:`slicer_download.NORMALIZED_COLUMNS`.
+    """
+    try:
+        normalized = adapter.getNormalizedRecord(r)
+    except (KeyError, ValueError):
+        return None
+    return [normalized[column] for column, _ in NORMALIZED_COLUMNS]
+
+
+def insertNormalizedRecords(db, records, adapter):
+    db.executemany('''insert or replace into packages({columns}) values({placeholders})'''.format(
+        columns=','.join(column for column, _ in NORMALIZED_COLUMNS),
+        placeholders=','.join('?' * len(NORMALIZED_COLUMNS))),
+        [_f for _f in (normalizedRecordToDb(r, adapter) for r in records) if _f])
+
+
+def createChangeLog(db, table):
+    """Create the ``change_log`` table along with the triggers listing the rowids of
+    the rows of ``table`` inserted, updated or deleted.
+
+    The server only reads the rows listed since its previous load (see
+    :class:`slicer_download_server.RecordsLoader`). Rows deleted by ``insert or
+    replace`` statements are only listed if recursive triggers are enabled.
+    """
+    db.execute('''create table if not exists
+        change_log(id INTEGER primary key autoincrement, table_name TEXT, row INTEGER)''')
+    for event, references in (('insert', ('new',)), ('update', ('old', 'new')), ('delete', ('old',))):
+        db.execute('''create trigger if not exists {table}_{event}_log after {event} on {table}
+            begin {statements} end'''.format(
+            table=table, event=event, statements=' '.join(
+                "insert into change_log(table_name, row) values('{0}', {1}.rowid);".format(table, reference)
+                for reference in references)))
+
+
+def pruneChangeLog(db):
+    """Only keep the last :const:`CHANGE_LOG_SIZE` entries of the ``change_log`` table."""
+    db.execute('delete from change_log where id <= (select max(id) from change_log) - ?', [CHANGE_LOG_SIZE])
+
+
+def createNormalizedTable(db, adapter, primary_key_type):
+    """Create the ``packages`` table holding one row of typed columns per record.
+
+    The table is re-created if its schema version differs from
+    :const:`slicer_download.NORMALIZED_SCHEMA_VERSION`. Records found in the ``_``
+    table and missing from the ``packages`` table are then added.
+    """
+    schema_version = db.execute('pragma user_version').fetchone()[0]
+    if schema_version != NORMALIZED_SCHEMA_VERSION:
+        db.execute('drop table if exists packages')
+
+    db.execute('''create table if not exists packages({columns})'''.format(
+        columns=', '.join(
+            '{0} {1}{2}'.format(
+                column,
+                column_type or primary_key_type,
+                ' primary key' if column == 'item_id' else '')
+            for column, column_type in NORMALIZED_COLUMNS)))
+    db.execute('''create index if not exists packages_os_revision_idx
+        on packages(os, revision desc, build_date desc)''')
+    # allow the server to read all the records without sorting them
+    db.execute('''create index if not exists packages_revision_idx
+        on packages(revision desc, build_date desc)''')
+    db.execute('''create index if not exists packages_version_idx on packages(version)''')
+    createChangeLog(db, 'packages')
+    db.execute('pragma user_version = {0}'.format(NORMALIZED_SCHEMA_VERSION))
+
+    rows = db.execute('select record from _ where item_id not in (select item_id from packages)').fetchall()
+    if rows:
+        print("Normalizing {0} records".format(len(rows)))
+        insertNormalizedRecords(db, (json.loads(record) for record, in rows), adapter)
+
+
+def recordHash(record_json):
+    """Return hash of the JSON document stored in the ``record`` column."""
+    return hashlib.sha1(record_json.encode('utf-8')).hexdigest()
+
+
+def updateRecordHashColumn(db):
+    """Add the ``record_hash`` column to a table created by an earlier version of this
+    script and fill it."""
+    columns = [row[1] for row in db.execute('pragma table_info(_)')]
+    if 'record_hash' not in columns:
+        db.execute('alter table _ add column record_hash TEXT')
+    db.create_function('record_hash', 1, recordHash, deterministic=True)
+    db.execute('update _ set record_hash = record_hash(record) where record_hash is null')
+
+
+def insertRecords(db, records, adapter):
+    """Insert new and modified ``records`` into the ``_`` and ``packages`` tables by
+    chunks of :const:`INSERT_CHUNK_SIZE` records.
+
+    Records are compared with the stored ones using the ``record_hash`` column, only
+    the records whose content changed are written.
+
+    ``records`` may be any iterable, only one chunk is kept in memory at once.
+
+    Return the number of records and the number of records written.
+    """
+    count = 0
+    changed = 0
+    records = iter(records)
+    while True:
+        chunk = list(itertools.islice(records, INSERT_CHUNK_SIZE))
+        if not chunk:
+            return count, changed
+        count += len(chunk)
+
+        rows = [(r, row + [recordHash(row[4])]) for r, row in ((r, recordToDb(r, adapter)) for r in chunk) if row]
+        storedHashes = dict(db.execute(
+            'select item_id, record_hash from _ where item_id in ({0})'.format(','.join('?' * len(rows))),
+            [row[0] for _, row in rows]))
+        rows = [(r, row) for r, row in rows if storedHashes.get(row[0]) != row[-1]]
+        if not rows:
+            continue
+
+        db.executemany('''insert or replace into _
+            (item_id, revision, checkout_date, build_date, record, os, stability, submissiontype, version, record_hash)
+            values(?,?,?,?,?,?,?,?,?,?)''', [row for _, row in rows])
+        insertNormalizedRecords(db, [r for r, _ in rows], adapter)
+        changed += len(rows)
+
+
+def publishedVersion(db):
+    """Return version of the database content or 0 if it was never published.
+
+    The version is incremented each time records are written (see :func:`main`).
+    """
+    row = db.execute('select version from publication').fetchone()
+    return row[0] if row else 0
 
 
-def main(dbfile):
+def updatePublishedVersion(db):
+    version = publishedVersion(db) + 1
+    db.execute('delete from publication')
+    db.execute("insert into publication(version, date) values(?, datetime('now'))", [version])
+    return version
+
+
+def stageDatabase(dbfile, staging_dbfile):
+    """Copy ``dbfile`` into ``staging_dbfile`` using the sqlite backup API.
+
+    The staged copy does not use a write-ahead log so that it is self-contained
+    once renamed.
+    """
+    if os.path.exists(staging_dbfile):
+        os.unlink(staging_dbfile)
+    staging_db = sqlite3.connect(staging_dbfile)
+    try:
+        if os.path.exists(dbfile):
+            db = sqlite3.connect(dbfile)
+            try:
+                db.backup(staging_db)
+            finally:
+                db.close()
+            shutil.copymode(dbfile, staging_dbfile)
+        staging_db.execute('pragma journal_mode=delete')
+    finally:
+        staging_db.close()
+
+
+def leaveWriteAheadLogMode(dbfile):
+    """Switch ``dbfile`` from write-ahead log to rollback journal mode.
+
+    The write-ahead log is checkpointed and removed. Return False if the database
+    uses a write-ahead log and is opened by another process (e.g. the server), the
+    mode can then not be changed.
+
+    A database replaced by an atomic rename must not use a write-ahead log: the
+    ``<dbfile>-wal`` file of the replaced database would be associated with the
+    new one.
+    """
+    if not os.path.exists(dbfile):
+        return True
+    with open(dbfile, 'rb') as fp:
+        header = fp.read(20)
+    if header[18:20] != b'\x02\x02' and not os.path.exists(dbfile + '-wal'):
+        return True
+    db = sqlite3.connect(dbfile, timeout=0)
+    try:
+        return db.execute('pragma journal_mode=delete').fetchone()[0] == 'delete'
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        db.close()
+
+
+def lastFullUpdateDate(db):
+    """Return UTC date of the last update downloading all the records or ``None``."""
+    row = db.execute('select date from full_update').fetchone()
+    return datetime.datetime.strptime(row[0], '%Y-%m-%d %H:%M:%S') if row else None
+
+
+def updateLastFullUpdateDate(db):
+    db.execute('delete from full_update')
+    db.execute("insert into full_update(date) values(datetime('now'))")
+
+
+def newestRecordDate(db):
+    """Return creation date of the newest record found in the database or ``None``."""
+    return db.execute('select max({0}) from _'.format(CREATION_DATE_COLUMN[getServerAPI()])).fetchone()[0]
+
+
+def fetchCutoffDate(db):
+    """Return date of the oldest records downloaded by an incremental update or
+    ``None`` if the database has no record.
+
+    The date is the day :const:`FETCH_OVERLAP` before the newest record was created.
+    It is formatted as ``YYYY-MM-DD``, a prefix of the creation dates of both server
+    APIs, so that it can be compared with them (see :func:`slicer_download.iterRecordsFromURL`).
+    Records already stored are only written again if their content changed.
+    """
+    newest = newestRecordDate(db)
+    if not newest:
+        return None
+    return (datetime.date.fromisoformat(newest[:10]) - FETCH_OVERLAP).isoformat()
+
+
+def readValidators(db):
+    """Return dictionary associating URLs with the ``ETag`` and ``Last-Modified``
+    values returned by the server API during the last update.
+
+    See :func:`slicer_download.fetchJSON`.
+    """
+    return {url: {'etag': etag, 'last_modified': last_modified}
+            for url, etag, last_modified in db.execute('select url, etag, last_modified from validators')}
+
+
+def writeValidators(db, validators):
+    db.executemany('''insert or replace into validators(url, etag, last_modified) values(?,?,?)''',
+                   [(url, values['etag'], values['last_modified']) for url, values in validators.items()])
+
+
+def main(dbfile, full=False, publish=False):
+    """Download package metadata and update ``dbfile``.
+
+    If ``publish`` is False, ``dbfile`` is updated in place using a write-ahead log,
+    allowing the server to keep reading it while it is updated.
+
+    If ``publish`` is True, a staged copy ``<dbfile>.staging`` is updated and then
+    atomically renamed to ``dbfile`` if records were written. The script exits
+    with an error if ``dbfile`` uses a write-ahead log and is in use (see
+    :func:`leaveWriteAheadLogMode`).
+
+    In both cases, the ``publication`` table stores a version incremented each time
+    records are written.
+    """
 
     print("ServerAPI is {0}: {1}".format(getServerAPI().name, getServerAPIUrl()))
 
-    records = getRecordsFromURL()
+    adapter = getServerAPIAdapter()
 
     primary_key_type = "INTEGER" if getServerAPI() == ServerAPI.Midas_v1 else "TEXT"
 
-    with sqlite3.connect(dbfile) as db:
+    target_dbfile = dbfile
+    if publish:
+        if not leaveWriteAheadLogMode(dbfile):
+            print(textwrap.dedent("""
+            {0} uses a write-ahead log and is in use: it can not be replaced.
+
+            Either update it in place (without --publish) or stop the server and
+            run this script again to switch it to rollback journal mode.
+            """.format(dbfile)), file=sys.stderr)
+            sys.exit(1)
+        target_dbfile = dbfile + '.staging'
+        stageDatabase(dbfile, target_dbfile)
+
+    db = sqlite3.connect(target_dbfile)
+    if not publish:
+        db.execute('pragma journal_mode=wal')
+    try:
+        changed, full = updateDb(db, adapter, primary_key_type, full)
+    finally:
+        db.close()
+
+    if publish:
+        # the date of the full update is recorded even if no record changed
+        if changed or full:
+            os.replace(target_dbfile, dbfile)
+        else:
+            os.unlink(target_dbfile)
+
+    print("Saved {0}".format(dbfile) if changed else "{0} is up to date".format(dbfile))
+
+
+def updateDb(db, adapter, primary_key_type, full):
+    """Create or update the tables of ``db`` and insert the downloaded records.
+
+    All the records are downloaded if ``full`` is True or if the last full update is
+    older than :const:`FULL_UPDATE_INTERVAL`.
+
+    Return the number of records written and whether all the records were downloaded.
+    """
+    # rows deleted by "insert or replace" are listed in the change log
+    db.execute('pragma recursive_triggers = on')
+    with db:
         db.execute('''create table if not exists
         _(item_id {primary_key_type} primary key,
                     revision INTEGER,
                     checkout_date TEXT,
                     build_date TEXT,
-                    record TEXT)'''.format(primary_key_type=primary_key_type))
+                    record TEXT,
+                    os TEXT,
+                    stability TEXT,
+                    submissiontype TEXT,
+                    version TEXT,
+                    record_hash TEXT)'''.format(primary_key_type=primary_key_type))
+        createChangeLog(db, '_')
 
-        cursor = db.cursor()
-        cursor.executemany('''insert or ignore into _
-            (item_id, revision, checkout_date, build_date, record)
-            values(?,?,?,?,?)''',
-                           [_f for _f in (recordToDb(r) for r in records) if _f])
-        db.commit()
+        updateIndexedColumns(db, adapter)
+        updateRecordHashColumn(db)
+        createNormalizedTable(db, adapter, primary_key_type)
+        db.execute('''create table if not exists
+        validators(url TEXT primary key, etag TEXT, last_modified TEXT)''')
+        db.execute('''create table if not exists publication(version INTEGER, date TEXT)''')
+        db.execute('''create table if not exists full_update(date TEXT)''')
 
-    print("Retrieved {0} records".format(len(records)))
-    print("Saved {0}".format(dbfile))
+        lastFullUpdate = lastFullUpdateDate(db)
+        if not full and (lastFullUpdate is None
+                         or datetime.datetime.utcnow() - lastFullUpdate >= FULL_UPDATE_INTERVAL):
+            # records modified upstream are only found by downloading all of them
+            print("Last full update on {0}: retrieving all records".format(lastFullUpdate or 'never'))
+            full = True
+
+        if full:
+            newerThan = None
+            validators = {}
+        else:
+            newerThan = fetchCutoffDate(db)
+            validators = readValidators(db)
+            if newerThan:
+                print("Retrieving records created on or after {0}".format(newerThan))
+
+        count, changed = insertRecords(db, iterRecordsFromURL(newerThan=newerThan, validators=validators), adapter)
+        writeValidators(db, validators)
+        if full:
+            updateLastFullUpdateDate(db)
+        pruneChangeLog(db)
+        if changed:
+            print("Published version {0}".format(updatePublishedVersion(db)))
+
+    print("Retrieved {0} records, {1} new or modified".format(count, changed))
+    return changed, full
 
 
 if __name__ == '__main__':
-    if len(sys.argv) != 2:
+    args = sys.argv[1:]
+    options = {option: option in args for option in ('--full', '--publish')}
+    args = [arg for arg in args if arg not in options]
+    if len(args) != 1:
         print(textwrap.dedent("""
-        Usage: %s DB_FILE
+        Usage: %s [--full] [--publish] DB_FILE
 
           Download Slicer application package metadata and update sqlite database
 
+          Only the records created since two days before the newest record found
+          in the database are downloaded, unless --full is specified or the last
+          update downloading all the records is older than one day. Records
+          modified upstream are only updated when all the records are downloaded.
+
+          If --publish is specified, a copy of the database is updated and then
+          atomically renamed to DB_FILE. DB_FILE must not be in use if it was
+          previously updated in place using a write-ahead log.
+
         """ % sys.argv[0]), file=sys.stderr)
         sys.exit(1)
 
-    main(sys.argv[1])
+    main(args[0], full=options['--full'], publish=options['--publish'])
@@ -22,6 +22,7 @@ def main():
     argparser.add_argument('--geoip', required=True, help="geoip data file")
     argparser.add_argument('--statsdata', required=True, help="slicer stats output")
     argparser.add_argument('--nomidas', action='store_true', help="don't download midas data")
+    argparser.add_argument('--jobs', type=int, default=1, help="number of processes parsing log files")
     argparser.add_argument('filenames', nargs="*")
     args = argparser.parse_args()
     dbname = args.db
@@ -37,7 +38,7 @@ def main():
     useragent.create_useragent_table(db)
 
     # parse apache logs, if they exist, and add them to db
-    access.add_access_info(db, filenames)
+    access.add_access_info(db, filenames, args.jobs)
 
     # each of these items depends on the access table
     geoip.add_geoip_info(db, geoip_filename)
@@ -1,6 +1,10 @@
+import concurrent.futures
 import sys
 import re
 import gzip
+import datetime
+import hashlib
+import mmap
 import os
 import apache_log_parser
 
@@ -14,6 +18,33 @@ bitstreamRE = {
     ServerAPI.Girder_v1: re.compile(r'/bitstream/([a-fA-F\d]{24})')
 }
 
+# Fast path for the lines of the format described in create_log_parser() with an IPv4
+# address, a whole hour UTC offset and a request path without parameters. The fields
+# extracted are the same as the generic parser ones.
+accessLineRE = re.compile(
+    r'((?:\d{1,3}\.){3}\d{1,3}) \S* \S* '
+    r'\[(\d\d/(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)/\d{4}:\d\d:\d\d:\d\d) ([+-]\d\d)00\] '
+    r'"(?:GET|HEAD|POST|OPTIONS|PUT|CONNECT|PATCH|PROPFIND|DELETE) '
+    r'(/(?!/)[^"\s?#;]*)(?:[?#][^"\s]*)? HTTP/1\.[01]" '
+    r'(?:\d+|-) (?:\d+|-) "[^"]*" "([^"]*)"')
+
+MONTHS = {
+    'Jan': '01', 'Feb': '02', 'Mar': '03', 'Apr': '04', 'May': '05', 'Jun': '06',
+    'Jul': '07', 'Aug': '08', 'Sep': '09', 'Oct': '10', 'Nov': '11', 'Dec': '12'
+}
+
+# Bytes found in every line possibly matching bitstreamRE
+BITSTREAM_MARKER = b'/bitstream/'
+
+# Number of uncompressed bytes read at once from a compressed log
+READ_SIZE = 1024 * 1024
+
+# Minimum number of bytes of the ranges of an uncompressed log parsed in parallel
+SPLIT_SIZE = 64 * 1024 * 1024
+
+# Maximum number of bytes of the first line used to identify a log file
+HEAD_SIZE = 4096
+
 
 def create_access_table(db):
     "Initialize sqlite table for web access records."
@@ -26,51 +57,294 @@ def create_access_table(db):
         c.execute('''create unique index if not exists access_unique_idx
                     on access(bitstream_id, ip, ts)''')
 
+        # Each log content is identified by the hash of its first line, it is
+        # preserved when the log is rotated (renamed) or compressed. The offset
+        # is the number of uncompressed bytes already parsed.
+        c.execute('''create table if not exists
+                access_checkpoint (head_hash primary key, filename,
+                                   inode, size, offset, complete)
+                ''')
+
 
-def add_access_info(db, filenames):
-    """Add bitstream access information to sqlite table."""
-    print("populating 'access' table")
-    for access in read_and_parse(filenames):
-        req = access['request_url_path']
-        m = bitstreamRE[getServerAPI()].match(req)
-        if not m:
-            continue
+def is_compressed(filename):
+    return os.path.splitext(filename)[1] == '.gz'
 
-        host = access['remote_ip']
-        user_agent = access['request_header_user_agent']
-        access_time = access['time_received_utc_isoformat']
-        bitstream_id = m.group(1)
-        db.execute("""insert or ignore into access(bitstream_id, ip, ts, useragent)
-                    values(?, ?, ?, ?)""",
-                    (bitstream_id, host, access_time, user_agent))
-    db.commit()
 
+def open_log(filename):
+    "Open apache log file (possibly gzipped) in binary mode."
+    if is_compressed(filename):
+        return gzip.open(filename, 'rb')
+    return open(filename, 'rb')
+
+
+def read_log_head(filename):
+    """Return first line of the log file (at most :const:`HEAD_SIZE` bytes) or
+    ``None`` if the file does not start with a complete line yet."""
+    with open_log(filename) as fp:
+        head = fp.readline(HEAD_SIZE)
+    if not head or (not head.endswith(b'\n') and len(head) < HEAD_SIZE and not is_compressed(filename)):
+        # empty or being written
+        return None
+    return head
 
-def read_and_parse(filenames):
-    """Read all apache log files (possibly gzipped) and 
-       yield each parsed bitsteam download event."""
-    log_parser = create_log_parser()
-    for filename in filenames:
-        print("parsing '{0}'".format(filename))
 
+def get_log_checkpoint(db, filename):
+    """Return dictionary describing the part of ``filename`` already parsed or
+    ``None`` if there is nothing new to parse.
+
+    The returned dictionary has the ``head_hash``, ``filename``, ``inode``, ``size``,
+    ``offset`` and ``complete`` keys. The ``offset`` is the number of uncompressed
+    bytes already parsed.
+
+    See :func:`update_log_checkpoint`.
+    """
+    stat = os.stat(filename)
+    head = read_log_head(filename)
+    if head is None:
+        print("skipping '{0}': no complete line".format(filename))
+        return None
+
+    head_hash = hashlib.sha1(head).hexdigest()
+    row = db.execute('''select offset, complete, inode, size from access_checkpoint
+                     where head_hash = ?''', (head_hash,)).fetchone()
+    checkpoint = {
+        'head_hash': head_hash,
+        'filename': filename,
+        'inode': stat.st_ino,
+        'size': stat.st_size,
+        'offset': 0,
+        'complete': False
+    }
+    if row is None:
+        return checkpoint
+
+    offset, complete, inode, size = row
+    if complete or (inode, size) == (stat.st_ino, stat.st_size):
+        print("skipping '{0}': already parsed".format(filename))
+        return None
+    if is_compressed(filename) or offset <= stat.st_size:
+        # the content of a compressed log is the content of the log before rotation
+        checkpoint['offset'] = offset
+    return checkpoint
+
+
+def update_log_checkpoint(db, checkpoint, offset):
+    """Record that ``checkpoint['filename']`` has been parsed up to ``offset``.
+
+    Compressed logs are not expected to grow anymore, they are marked as complete.
+    """
+    db.execute('''insert or replace into access_checkpoint(head_hash, filename,
+                inode, size, offset, complete) values(?, ?, ?, ?, ?, ?)''',
+               (checkpoint['head_hash'], checkpoint['filename'],
+                checkpoint['inode'], checkpoint['size'], offset,
+                is_compressed(checkpoint['filename'])))
+
+
+def add_access_info(db, filenames, jobs=1):
+    """Add bitstream access information to sqlite table.
+
+    Only the part of each log file not already parsed by a previous run is read,
+    see :func:`get_log_checkpoint`.
+
+    If ``jobs`` is greater than one, log files are parsed in parallel by ``jobs``
+    worker processes while the current process inserts the parsed accesses.
+    """
+    print("populating 'access' table")
+    checkpoints = []
+    for filename in filenames:
         if not os.path.exists(filename):
             print("failed to open '{0}': file do not exist !".format(filename), file=sys.stderr)
             continue
 
-        if os.path.splitext(filename)[1] == '.gz':
-            fp = gzip.open(filename, 'rt')
-        else:
-            fp = open(filename)
-        for line in fp:
-            if not bitstreamRE[getServerAPI()].search(line):
+        checkpoint = get_log_checkpoint(db, filename)
+        if checkpoint is not None:
+            checkpoints.append(checkpoint)
+
+    results = parse_logs([checkpoint['filename'] for checkpoint in checkpoints],
+                         [checkpoint['offset'] for checkpoint in checkpoints], jobs)
+    for checkpoint, (accesses, offset, failed_lines) in zip(checkpoints, results):
+        print("parsed '{0}' from offset {1}: {2} accesses".format(
+            checkpoint['filename'], checkpoint['offset'], len(accesses)))
+        for line in failed_lines:
+            print("failed to parse '{0}'".format(line), file=sys.stderr)
+        with db:
+            db.executemany("""insert or ignore into access(bitstream_id, ip, ts, useragent)
+                    values(?, ?, ?, ?)""", accesses)
+            update_log_checkpoint(db, checkpoint, offset)
+
+
+def parse_logs(filenames, offsets, jobs=1):
+    """Yield result of :func:`read_and_parse` for each of ``filenames`` starting
+    at the corresponding offset, in order.
+
+    If ``jobs`` is greater than one, files are parsed using a pool of ``jobs``
+    processes. Uncompressed logs larger than :const:`SPLIT_SIZE` are split into
+    line aligned byte ranges (see :func:`split_log`) parsed by different processes,
+    the results of the ranges are then concatenated in order.
+    """
+    if jobs <= 1:
+        access_parser = create_access_parser()
+        for filename, offset in zip(filenames, offsets):
+            yield read_and_parse(filename, offset, access_parser)
+        return
+
+    ranges = [split_log(filename, offset, jobs) for filename, offset in zip(filenames, offsets)]
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        results = executor.map(read_and_parse_range,
+                               [filename for filename, file_ranges in zip(filenames, ranges) for _ in file_ranges],
+                               [start for file_ranges in ranges for start, _ in file_ranges],
+                               [end for file_ranges in ranges for _, end in file_ranges])
+        for file_ranges in ranges:
+            accesses, failed_lines = [], []
+            for _ in file_ranges:
+                range_accesses, offset, range_failed_lines = next(results)
+                accesses.extend(range_accesses)
+                failed_lines.extend(range_failed_lines)
+            yield accesses, offset, failed_lines
+
+
+def split_log(filename, offset, count):
+    """Return list of at most ``count`` ``(start, end)`` byte ranges covering
+    ``filename`` from ``offset``.
+
+    Ranges start at the beginning of a line and are at least :const:`SPLIT_SIZE`
+    bytes long. The end of the last range is ``None``, meaning the end of the last
+    complete line (see :func:`read_and_parse`). Compressed logs are not split.
+    """
+    starts = [offset]
+    if not is_compressed(filename):
+        size = os.path.getsize(filename)
+        count = max(1, min(count, (size - offset) // SPLIT_SIZE))
+        with open(filename, 'rb') as fp:
+            for index in range(1, count):
+                fp.seek(offset + (size - offset) * index // count)
+                if not fp.readline().endswith(b'\n'):
+                    break
+                starts.append(fp.tell())
+    return list(zip(starts, starts[1:] + [None]))
+
+
+def read_and_parse_range(filename, start, end):
+    return read_and_parse(filename, start, end=end)
+
+
+def read_and_parse(filename, offset=0, access_parser=None, end=None):
+    """Read apache log file (possibly gzipped) starting at ``offset``.
+
+    Return the list of ``(bitstream_id, ip, ts, useragent)`` bitstream download
+    events, the offset following the last parsed line and the list of the lines
+    that could not be parsed.
+
+    The last line of an uncompressed log is only parsed if it is complete, the log
+    may still be written. If ``end`` is set, the uncompressed log is only parsed up
+    to this offset, expected to be the beginning of a line (see :func:`split_log`).
+
+    Only the lines containing :const:`BITSTREAM_MARKER` are decoded and parsed, they
+    are found by searching the memory mapped file or, for a compressed log, the
+    chunks of :const:`READ_SIZE` uncompressed bytes.
+    """
+    if access_parser is None:
+        access_parser = create_access_parser()
+    bitstream_re = bitstreamRE[getServerAPI()]
+    accesses = []
+    failed_lines = []
+
+    def parse_lines(data, start, end):
+        for line in iter_marked_lines(data, start, end):
+            line = line.decode('utf-8', 'replace')
+            if not bitstream_re.search(line):
                 # if no bitstream ID, don't go any further
                 continue
             try:
-                p = log_parser(line)
+                host, path, access_time, user_agent = access_parser(line)
             except apache_log_parser.LineDoesntMatchException:
-                print("failed to parse '{0}'".format(line), file=sys.stderr)
+                failed_lines.append(line)
+                continue
+
+            m = bitstream_re.match(path)
+            if not m:
                 continue
-            yield p
+            accesses.append((m.group(1), host, access_time, user_agent))
+
+    if not is_compressed(filename):
+        with open(filename, 'rb') as fp:
+            size = os.fstat(fp.fileno()).st_size
+            if size <= offset:
+                return accesses, offset, failed_lines
+            with mmap.mmap(fp.fileno(), size, access=mmap.ACCESS_READ) as data:
+                if end is None:
+                    end = data.rfind(b'\n', offset) + 1
+                if end > offset:
+                    parse_lines(data, offset, end)
+                    offset = end
+        return accesses, offset, failed_lines
+
+    with open_log(filename) as fp:
+        fp.seek(offset)
+        remainder = b''
+        while True:
+            chunk = fp.read(READ_SIZE)
+            data = remainder + chunk
+            # the last line of a compressed log is complete
+            end = data.rfind(b'\n') + 1 if chunk else len(data)
+            parse_lines(data, 0, end)
+            offset += end
+            remainder = data[end:]
+            if not chunk:
+                break
+    return accesses, offset, failed_lines
+
+
+def iter_marked_lines(data, start, end, marker=BITSTREAM_MARKER):
+    """Yield lines of ``data[start:end]`` containing ``marker``.
+
+    ``data`` is a ``bytes`` or ``mmap`` object, ``start`` and ``end`` are expected
+    to be line boundaries.
+    """
+    position = data.find(marker, start, end)
+    while position != -1:
+        line_start = max(start, data.rfind(b'\n', start, position) + 1)
+        line_end = data.find(b'\n', position, end)
+        line_end = end if line_end == -1 else line_end + 1
+        yield data[line_start:line_end]
+        position = data.find(marker, line_end, end)
+
+
+def utc_isoformat(time_received, utc_offset_hours):
+    """Convert apache time (e.g. ``01/Sep/2012:06:05:11``) associated with a UTC
+    offset in hours (e.g. ``-04``) into UTC ISO 8601 format."""
+    if utc_offset_hours in ('+00', '-00'):
+        return '{0}-{1}-{2}T{3}+00:00'.format(
+            time_received[7:11], MONTHS[time_received[3:6]], time_received[0:2], time_received[12:20])
+    local_time = datetime.datetime(
+        int(time_received[7:11]), int(MONTHS[time_received[3:6]]), int(time_received[0:2]),
+        int(time_received[12:14]), int(time_received[15:17]), int(time_received[18:20]))
+    return (local_time - datetime.timedelta(hours=int(utc_offset_hours))).isoformat() + '+00:00'
+
+
+def create_access_parser():
+    """Create function parsing an apache log entry into ``(remote_ip, request_url_path,
+    time_received_utc_isoformat, user_agent)``.
+
+    Entries not handled by :const:`accessLineRE` are parsed using the parser returned
+    by :func:`create_log_parser`, raising ``apache_log_parser.LineDoesntMatchException``
+    if the entry is invalid.
+    """
+    log_parser = create_log_parser()
+
+    def parse_access(line):
+        m = accessLineRE.match(line)
+        if m is not None:
+            host, time_received, utc_offset_hours, path, user_agent = m.groups()
+            return host, path, utc_isoformat(time_received, utc_offset_hours), user_agent
+
+        p = log_parser(line)
+        return (p['remote_ip'],
+                p['request_url_path'],
+                p['time_received_utc_isoformat'],
+                p['request_header_user_agent'])
+
+    return parse_access
 
 
 def create_log_parser():
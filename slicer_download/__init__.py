@@ -1,6 +1,11 @@
+import codecs
+import concurrent.futures
+import dateutil.parser
 import json
 import os
+import re
 import requests
+import requests.adapters
 import sqlite3
 import sys
 import urllib.error
@@ -19,6 +24,290 @@ def getServerAPI():
     return ServerAPI[os.getenv("SLICER_DOWNLOAD_SERVER_API", ServerAPI.Midas_v1.name)]
 
 
+# this looks ugly because we need to be able to accept versions like:
+# 4.5.0, 4.5.0-1, 4.5.0-rc2, 4.5.0-gamma, and so forth
+
+
+VersionWithDateRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
+VersionRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(macosx|linux|win+)')
+VersionFullRE = re.compile(r'^([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
+
+
+# Version of the normalized ``packages`` table schema. It is stored in the database
+# using ``PRAGMA user_version`` and should be incremented whenever the columns change.
+NORMALIZED_SCHEMA_VERSION = 2
+
+# Fields of the cleaned up records (see :meth:`RecordAdapter.getCleanedUpRecord`)
+CLEANED_FIELDS = (
+    'arch',
+    'revision',
+    'os',
+    'codebase',
+    'name',
+    'package',
+    'build_date',
+    'build_date_ymd',
+    'checkout_date',
+    'checkout_date_ymd',
+    'product_name',
+    'stability',
+    'size',
+    'md5',
+    'version'
+)
+
+# Columns of the normalized ``packages`` table and their types. They include the cleaned
+# up record fields and the fields needed to index records. The ``size`` column has no
+# type affinity so that values are returned as found in the raw records (e.g strings
+# for Midas and integers for Girder).
+NORMALIZED_COLUMNS = (
+    ('item_id', None),  # type depends on the server API
+    ('bitstream_id', 'TEXT'),
+    ('revision', 'INTEGER'),
+    ('os', 'TEXT'),
+    ('arch', 'TEXT'),
+    ('codebase', 'TEXT'),
+    ('name', 'TEXT'),
+    ('package', 'TEXT'),
+    ('build_date', 'TEXT'),
+    ('build_date_ymd', 'TEXT'),
+    ('checkout_date', 'TEXT'),
+    ('checkout_date_ymd', 'TEXT'),
+    ('product_name', 'TEXT'),
+    ('stability', 'TEXT'),
+    ('release', 'TEXT'),
+    ('submissiontype', 'TEXT'),
+    ('size', 'BLOB'),
+    ('md5', 'TEXT'),
+    ('version', 'TEXT')
+)
+
+
+class RecordAdapter:
+    """Base class providing access to the fields of package records returned by
+    a server API.
+
+    Subclasses set the following attributes:
+
+    * ``serverAPI``: associated :class:`ServerAPI`.
+    * ``sourceDownloadURLTemplate``: package download URL with ``{0}`` placeholder
+      for the package identifier.
+    * ``versionREs``: regular expressions tried in order to extract the version
+      from the value returned by :meth:`getVersionString`.
+    * ``unsupportedModes``: names of the matching modes not supported by the server API.
+    * ``fieldGetters``: dictionary mapping field names to functions returning the
+      associated value given a record.
+
+    See :func:`getServerAPIAdapter`.
+    """
+
+    serverAPI = None
+    sourceDownloadURLTemplate = None
+    versionREs = ()
+    unsupportedModes = ()
+    fieldGetters = {}
+
+    def getField(self, record, key):
+        """Return value associated with ``key``.
+
+        If no getter is associated with ``key``, :meth:`getDefaultField` is called.
+        """
+        getter = self.fieldGetters.get(key)
+        if getter is None:
+            return self.getDefaultField(record, key)
+        return getter(record)
+
+    def getDefaultField(self, record, key):
+        return None
+
+    def getVersionString(self, record):
+        raise NotImplementedError
+
+    def getVersion(self, record):
+        """Extract version information from record.
+
+        If ``release`` field is set, returns associated value.
+
+        Otherwise it returns the version extracted from the value returned by
+        :meth:`getVersionString` using the first matching regular expression listed
+        in ``versionREs``.
+
+        If the value does not match any of the regular expressions, it returns ``None``.
+        """
+        release = self.getField(record, 'release')
+        if release:
+            return release
+
+        versionString = self.getVersionString(record)
+        for versionRE in self.versionREs:
+            match = versionRE.match(versionString)
+            if match:
+                return match.group(1)
+        return None
+
+    def getStability(self, record):
+        """Return ``release`` if the record is associated with a release. Otherwise
+        return the value associated with the ``submissiontype`` field (e.g ``nightly``).
+        """
+        if self.getField(record, 'release') != "":
+            return 'release'
+        return self.getField(record, 'submissiontype')
+
+    def getSourceDownloadURL(self, package_identifier):
+        return self.sourceDownloadURLTemplate.format(package_identifier)
+
+    def getCleanedUpRecord(self, record):
+        """Return a dictionary generated from a raw record.
+
+        It includes new fields and more consistent names (see :const:`CLEANED_FIELDS`).
+        """
+        raise NotImplementedError
+
+    def getNormalizedRecord(self, record):
+        """Return a dictionary associating :const:`NORMALIZED_COLUMNS` with values
+        extracted from a raw record.
+
+        See :class:`NormalizedRecordAdapter`.
+        """
+        normalized = self.getCleanedUpRecord(record)
+        normalized['revision'] = int(normalized['revision'])
+        for field in ('item_id', 'bitstream_id', 'release', 'submissiontype'):
+            normalized[field] = self.getField(record, field)
+        return normalized
+
+
+class MidasRecordAdapter(RecordAdapter):
+    """Provide access to records returned by :const:`ServerAPI.Midas_v1`.
+
+    Version is extracted from the ``name`` key using first :const:`VersionWithDateRE`
+    and then :const:`VersionRE`.
+    """
+
+    serverAPI = ServerAPI.Midas_v1
+    sourceDownloadURLTemplate = "https://slicer.kitware.com/midas3/download?bitstream={0}"
+    versionREs = (VersionWithDateRE, VersionRE)
+    fieldGetters = {
+        'bitstream_id': lambda record: record['bitstreams'][0]['bitstream_id']
+    }
+
+    def getDefaultField(self, record, key):
+        return record[key]
+
+    def getVersionString(self, record):
+        return record['name']
+
+    def getCleanedUpRecord(self, record):
+        cleaned = {}
+
+        for field in (
+            'arch',
+            'revision',
+            'os',
+            'codebase',
+            'name',
+            'package'
+        ):
+            cleaned[field] = record[field]
+
+        cleaned['build_date'] = record['date_creation']
+        cleaned['build_date_ymd'] = cleaned['build_date'].split(' ')[0]
+        cleaned['checkout_date'] = record['checkoutdate']
+        cleaned['checkout_date_ymd'] = cleaned['checkout_date'].split(' ')[0]
+
+        cleaned['product_name'] = record['productname']
+        cleaned['stability'] = 'release' if record['release'] else 'nightly'
+        cleaned['size'] = record['bitstreams'][0]['size']
+        cleaned['md5'] = record['bitstreams'][0]['md5']
+        cleaned['version'] = self.getVersion(record)
+
+        return cleaned
+
+
+class GirderRecordAdapter(RecordAdapter):
+    """Provide access to records returned by :const:`ServerAPI.Girder_v1`.
+
+    Version is extracted from the ``meta.version`` key using :const:`VersionFullRE`.
+    """
+
+    serverAPI = ServerAPI.Girder_v1
+    sourceDownloadURLTemplate = "https://slicer-packages.kitware.com/api/v1/item/{0}/download"
+    versionREs = (VersionFullRE,)
+    unsupportedModes = ('checkout-date',)
+    fieldGetters = {
+        'os': lambda record: record['meta']['os'],
+        'revision': lambda record: record['meta']['revision'],
+        'date_creation': lambda record: record['meta']['build_date'],
+        'checkoutdate': lambda record: None,  # Not supported
+        'release': lambda record: record['meta'].get('release', ''),
+        'submissiontype': lambda record: 'release' if record['meta'].get('release') else 'nightly',
+        'bitstream_id': lambda record: record['_id'],
+        'item_id': lambda record: record['_id']
+    }
+
+    def getVersionString(self, record):
+        return record['meta']['version']
+
+    def getCleanedUpRecord(self, record):
+        cleaned = {}
+
+        cleaned['arch'] = record['meta']['arch']
+        cleaned['revision'] = record['meta']['revision']
+        cleaned['os'] = record['meta']['os']
+        cleaned['codebase'] = None  # Not supported
+        cleaned['name'] = record['name']
+        cleaned['package'] = None  # Not supported
+
+        cleaned['build_date'] = record['meta']['build_date']
+        cleaned['build_date_ymd'] = dateutil.parser.parse(record['meta']['build_date']).strftime("%Y-%m-%d")
+        cleaned['checkout_date'] = None  # Not supported
+        cleaned['checkout_date_ymd'] = None  # Not supported
+
+        cleaned['product_name'] = record['meta']['baseName']
+        cleaned['stability'] = 'release' if self.getField(record, 'release') else 'nightly'
+        cleaned['size'] = record['size']
+        cleaned['md5'] = None  # Not supported
+        cleaned['version'] = self.getVersion(record)
+
+        return cleaned
+
+
+class NormalizedRecordAdapter(RecordAdapter):
+    """Provide access to rows of the normalized ``packages`` table.
+
+    Rows are created by ``slicer_getbuildinfo`` using :meth:`RecordAdapter.getNormalizedRecord`.
+    Since the ``revision`` column is an integer, it is converted back to a string in
+    cleaned up records for consistency with the raw records of both server APIs.
+    """
+
+    fieldGetters = {
+        'date_creation': lambda record: record['build_date'],
+        'checkoutdate': lambda record: record['checkout_date']
+    }
+
+    def getDefaultField(self, record, key):
+        return record[key]
+
+    def getVersion(self, record):
+        return record['version']
+
+    def getCleanedUpRecord(self, record):
+        cleaned = {field: record[field] for field in CLEANED_FIELDS}
+        cleaned['revision'] = str(record['revision'])
+        return cleaned
+
+
+def getServerAPIAdapter():
+    """Return :class:`RecordAdapter` associated with :func:`getServerAPI`.
+
+    Since the server API is read from the environment, callers accessing records
+    in a loop are expected to retrieve the adapter once.
+    """
+    return {
+        ServerAPI.Midas_v1: MidasRecordAdapter,
+        ServerAPI.Girder_v1: GirderRecordAdapter,
+    }[getServerAPI()]()
+
+
 def getServerAPIUrl():
     return {
         ServerAPI.Midas_v1: "http://slicer.kitware.com/midas3/api/json",
@@ -26,33 +315,211 @@ def getServerAPIUrl():
     }[getServerAPI()]
 
 
-def getMidasRecordsFromURL():
+# Number of records requested per page and maximum number of pages requested
+# concurrently (see :func:`iterGirderRecordsFromURL`)
+FETCH_PAGE_SIZE = 200
+FETCH_WORKERS = 4
+
+# Timeout in seconds of the requests sent to the server API
+FETCH_TIMEOUT = 60
+
+# Size in bytes of the chunks read from streamed responses (see :func:`iterJSONArray`)
+STREAM_CHUNK_SIZE = 64 * 1024
+
+
+def createSession(workers=FETCH_WORKERS):
+    """Return :class:`requests.Session` keeping up to ``workers`` connections alive."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def openURL(session, url, validators=None):
+    """Return streamed response associated with ``url`` or ``None`` if it was not modified.
+
+    If ``validators`` is a dictionary, the ``ETag`` and ``Last-Modified`` values
+    previously associated with ``url`` are sent using the ``If-None-Match`` and
+    ``If-Modified-Since`` headers, and the values returned by the server are stored
+    back into the dictionary.
+
+    Responses are gzip compressed if supported by the server.
+    """
+    headers = {'Accept-Encoding': 'gzip'}
+    if validators is not None:
+        previous = validators.get(url, {})
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('last_modified'):
+            headers['If-Modified-Since'] = previous['last_modified']
+
+    response = session.get(url, headers=headers, timeout=FETCH_TIMEOUT, stream=True)
+    if response.status_code == requests.codes.not_modified:
+        response.close()
+        return None
+    response.raise_for_status()
+
+    if validators is not None:
+        validators[url] = {
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified')
+        }
+    return response
+
+
+def fetchJSON(session, url, validators=None):
+    """Return JSON document associated with ``url`` or ``None`` if it was not modified.
+
+    See :func:`openURL`.
+    """
+    response = openURL(session, url, validators)
+    if response is None:
+        return None
+    with response:
+        return response.json()
+
+
+def iterJSONArray(response, key):
+    """Yield the objects of the array associated with ``key`` in the JSON document
+    streamed by ``response``.
+
+    The document is decoded by chunks of :const:`STREAM_CHUNK_SIZE` bytes and each
+    object is parsed as soon as it was entirely received, the memory used is
+    independent of the size of the array. The array is expected to be the value of
+    the first occurrence of ``"<key>"`` in the document.
+
+    Raise :class:`ValueError` if the array is not found, invalid or truncated.
+    """
+    decoder = json.JSONDecoder()
+    utf8Decoder = codecs.getincrementaldecoder('utf-8')()
+    chunks = (utf8Decoder.decode(chunk) for chunk in response.iter_content(STREAM_CHUNK_SIZE))
+
+    marker = '"{0}"'.format(key)
+    buffer = ''
+    for chunk in chunks:
+        buffer += chunk
+        start = buffer.find(marker)
+        if start >= 0 and '[' in buffer[start:]:
+            buffer = buffer[buffer.index('[', start) + 1:]
+            break
+    else:
+        raise ValueError('array "%s" not found' % key)
+
+    position = 0
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer):
+            if buffer[position] == ']':
+                return
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                end = None  # item was not entirely received
+            # a number may continue in the next chunk (e.g. "-4.5" of "-4.5e6"), items are
+            # complete once followed by a separator or the end of the array
+            if end is not None and end < len(buffer) and buffer[end] in ' \t\r\n,]':
+                position = end
+                yield item
+                continue
+        chunk = next(chunks, None)
+        if chunk is None:
+            raise ValueError('array "%s" is invalid or truncated' % key)
+        buffer = buffer[position:] + chunk
+        position = 0
+
+
+def iterMidasRecordsFromURL(newerThan=None, validators=None, session=None):
+    """Yield records created on or after ``newerThan``.
+
+    Since the Midas API does not support pagination, all the records are requested
+    at once, streamed (see :func:`iterJSONArray`) and the older ones are discarded.
+
+    See :func:`openURL` for a description of ``validators``.
+    """
     InfoURLMethod = 'midas.slicerpackages.get.packages'
 
     infoURL = '{0}?productname=Slicer&method={1}'.format(getServerAPIUrl(), InfoURLMethod)
 
-    fp = urllib.request.urlopen(infoURL)
-    info = fp.read()
-    fp.close()
+    response = openURL(session or createSession(), infoURL, validators)
+    if response is None:
+        return
 
-    return json.loads(info)['data']
+    with response:
+        for record in iterJSONArray(response, 'data'):
+            if not newerThan or record['date_creation'] >= newerThan:
+                yield record
 
 
-def getGirderRecordsFromURL():
-    result = requests.get("{0}/app/5f4474d0e1d8c75dfc705482/package?limit=0".format(getServerAPIUrl()))
-    return result.json()
+def iterGirderRecordsFromURL(newerThan=None, validators=None, session=None):
+    """Yield records created on or after ``newerThan``.
+
+    Records are requested by pages of :const:`FETCH_PAGE_SIZE` records sorted by
+    decreasing creation date. After the first page, up to :const:`FETCH_WORKERS`
+    pages are requested concurrently. Requests stop after the last page or after a
+    page including records created before ``newerThan``.
+
+    Only the first page is requested conditionally (see :func:`openURL`). If it
+    was not modified, no record was added since the last request.
+    """
+    session = session or createSession()
+    pageURL = "{0}/app/5f4474d0e1d8c75dfc705482/package?limit={1}&offset={{0}}&sort=created&sortdir=-1".format(
+        getServerAPIUrl(), FETCH_PAGE_SIZE)
 
+    def isLastPage(page):
+        return len(page) < FETCH_PAGE_SIZE or (newerThan and page[-1]['created'] < newerThan)
 
-def getRecordsFromURL():
+    page = fetchJSON(session, pageURL.format(0), validators)
+    if page is None:
+        return
+    pages = [page]
+    pageCount = 1
+
+    with concurrent.futures.ThreadPoolExecutor(FETCH_WORKERS) as executor:
+        while True:
+            for page in pages:
+                for record in page:
+                    if not newerThan or record['created'] >= newerThan:
+                        yield record
+            if any(isLastPage(page) for page in pages):
+                break
+            offsets = [(pageCount + index) * FETCH_PAGE_SIZE for index in range(FETCH_WORKERS)]
+            pages = list(executor.map(lambda offset: fetchJSON(session, pageURL.format(offset)), offsets))
+            pageCount += len(pages)
+
+
+def iterRecordsFromURL(newerThan=None, validators=None):
+    """Yield records created on or after ``newerThan`` or all the records if not specified.
+
+    See :func:`iterMidasRecordsFromURL` and :func:`iterGirderRecordsFromURL`.
+    """
     return {
-        ServerAPI.Midas_v1: getMidasRecordsFromURL,
-        ServerAPI.Girder_v1: getGirderRecordsFromURL,
-    }[getServerAPI()]()
+        ServerAPI.Midas_v1: iterMidasRecordsFromURL,
+        ServerAPI.Girder_v1: iterGirderRecordsFromURL,
+    }[getServerAPI()](newerThan=newerThan, validators=validators)
 
 
-def openDb(database_filepath):
-    """Return opened database connection."""
-    database_connection = sqlite3.connect(database_filepath)
+def getRecordsFromURL(newerThan=None, validators=None):
+    """Return list of records created on or after ``newerThan`` or all the records if not specified.
+
+    See :func:`iterRecordsFromURL`.
+    """
+    return list(iterRecordsFromURL(newerThan=newerThan, validators=validators))
+
+
+def openDb(database_filepath, readonly=False):
+    """Return opened database connection.
+
+    If ``readonly`` is True, the database is opened in read-only mode and the
+    connection may be used from any thread. Callers are responsible for serializing
+    its use.
+    """
+    if readonly:
+        database_uri = 'file:{0}?mode=ro'.format(urllib.request.pathname2url(os.path.abspath(database_filepath)))
+        database_connection = sqlite3.connect(database_uri, uri=True, check_same_thread=False)
+    else:
+        database_connection = sqlite3.connect(database_filepath)
     database_connection.row_factory = sqlite3.Row
     return database_connection
 
@@ -1,18 +1,39 @@
 import flask
 from flask import json
 
-import dateutil.parser
+import collections
+import copy
+import fcntl
+import gc
+import gzip
+import hashlib
+import heapq
+import hmac
+import io
+import itertools
 import os
-import re
+import queue
+import sqlite3
+import threading
+import time
 
-from itertools import groupby, islice
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import slicer_download
 
 from slicer_download import (
-    getServerAPI,
+    getServerAPIAdapter,
+    NormalizedRecordAdapter,
+    NORMALIZED_SCHEMA_VERSION,
     ServerAPI,
     openDb
 )
 
+from . import metrics
+from . import profiling
+from . import snapshot
+
 SUPPORTED_OS_CHOICES = (
     'macosx',
     'win',
@@ -33,9 +54,27 @@ MODE_CHOICES = (
 
 LOCAL_BITSTREAM_PATH = '/bitstream'
 
+# Maximum number of queries accepted by a single /findbatch request
+MAX_BATCH_QUERIES = 256
+
+# Maximum number of rendered responses cached for each record index
+MAX_RENDERED_RESPONSES = 64
+
+# Maximum number of query results cached by each process (see ResolutionCache)
+MAX_RESOLVED_QUERIES = 1024
+
+# Maximum duration in seconds of a /debug/profile request
+MAX_PROFILE_SECONDS = 30
+
 app = flask.Flask(__name__)
 app.config.from_envvar('SLICER_DOWNLOAD_SERVER_CONF')
 
+# Adapter associated with the current server API. It is resolved once so that
+# accessing record fields never reads the environment.
+SERVER_API_ADAPTER = getServerAPIAdapter()
+
+SUPPORTED_MODE_CHOICES = [mode for mode in MODE_CHOICES if mode not in SERVER_API_ADAPTER.unsupportedModes]
+
 
 def getSourceDownloadURL(package_identifier):
     """Return package download URL for the current server API.
@@ -48,31 +87,50 @@ def getSourceDownloadURL(package_identifier):
     | Girder_v1   | https://slicer-packages.kitware.com/api/v1/item/<package_identifier>/download  |
     +-------------+--------------------------------------------------------------------------------+
 
-    See :func:`getServerAPI`.
+    See :const:`SERVER_API_ADAPTER`.
     """
-    return {
-        ServerAPI.Midas_v1: "https://slicer.kitware.com/midas3/download?bitstream={0}",
-        ServerAPI.Girder_v1: "https://slicer-packages.kitware.com/api/v1/item/{0}/download"
-    }[getServerAPI()].format(package_identifier)
+    return SERVER_API_ADAPTER.getSourceDownloadURL(package_identifier)
 
 
 @app.route('/')
 def downloadPage():
     """Render download page .
 
+    The rendered page is cached and served along with ``ETag`` and ``Last-Modified``
+    headers (see :func:`getRenderedResponse`).
+
     See :func:`recordsMatchingAllOSAndStability`.
     """
-    allRecords, error_message, error_code = recordsMatchingAllOSAndStability()
-    download_host_url = os.environ.get('SLICER_DOWNLOAD_HOSTNAME', flask.request.host_url).strip('/')
-    download_stats_url = '/'.join([download_host_url, 'download-stats'])
+    recordIndex = getRecordIndexFromDb()
+    download_stats_url = getDownloadStatsURL()
 
-    if allRecords:
-        return flask.render_template('download.html', R=allRecords, download_stats_url=download_stats_url)
+    key = ('download.html', download_stats_url) + renderedResponseKey()
+    rendered = lookupRenderedResponse(recordIndex, key)
+    if rendered is None:
+        allRecords, error_message, error_code = recordsMatchingAllOSAndStability(recordIndex)
 
-    if error_code in (400, 404):
-        return flask.render_template('{0}.html'.format(error_code), error_message=error_message), error_code
+        if not allRecords:
+            if error_code in (400, 404):
+                return flask.render_template(
+                    '{0}.html'.format(error_code), error_message=error_message), error_code
+            flask.abort(error_code)
+
+        with serverTiming('render'):
+            rendered = storeRenderedResponse(
+                recordIndex, key,
+                flask.render_template('download.html', R=allRecords, download_stats_url=download_stats_url))
+
+    return getRenderedResponse(recordIndex, rendered)
 
-    flask.abort(error_code)
+
+def getDownloadStatsURL():
+    """Return URL of the download statistics page.
+
+    The host is read from the ``SLICER_DOWNLOAD_HOSTNAME`` environment variable,
+    it defaults to the host of ``flask.request``.
+    """
+    download_host_url = os.environ.get('SLICER_DOWNLOAD_HOSTNAME', flask.request.host_url).strip('/')
+    return '/'.join([download_host_url, 'download-stats'])
 
 
 @app.route('/bitstream/<bitstreamId>')
@@ -136,124 +194,192 @@ def recordFindAllRequest():
     """Render as JSON document the list of matching records for all OS (see :const:`SUPPORTED_OS_CHOICES`)
     and stability (see :const:`STABILITY_CHOICES`)
 
+    The JSON document is cached and served along with ``ETag`` and ``Last-Modified``
+    headers (see :func:`getRenderedResponse`).
+
     See :func:`recordsMatchingAllOSAndStability` and :func:`recordMatching`.
     """
-    allRecords, error_message, error_code = recordsMatchingAllOSAndStability()
+    recordIndex = getRecordIndexFromDb()
 
-    if allRecords:
-        return json.dumps(allRecords)
+    key = ('findall',) + renderedResponseKey()
+    rendered = lookupRenderedResponse(recordIndex, key)
+    if rendered is None:
+        allRecords, error_message, error_code = recordsMatchingAllOSAndStability(recordIndex)
 
-    if error_code in (400, 404):
-        return flask.render_template('{0}.html'.format(error_code), error_message=error_message), error_code
+        if not allRecords:
+            if error_code in (400, 404):
+                return flask.render_template(
+                    '{0}.html'.format(error_code), error_message=error_message), error_code
+            flask.abort(error_code)
 
-    flask.abort(error_code)
+        with serverTiming('render'):
+            rendered = storeRenderedResponse(recordIndex, key, json.dumps(allRecords))
 
+    return getRenderedResponse(recordIndex, rendered)
 
-def getRecordField(record, key):
-    if getServerAPI() == ServerAPI.Midas_v1:
-        if key == 'bitstream_id':
-            return record['bitstreams'][0]['bitstream_id']
+
+@app.route('/findbatch', methods=['POST'])
+def recordFindBatchRequest():
+    """Render as JSON document the records matching a list of criteria.
+
+    The request body is expected to be a JSON list of objects. Each object accepts the
+    same fields as the ``/find`` query parameters (e.g ``{"os": "win", "revision": 29738}``).
+
+    All the queries are evaluated against the same records. The result is a list
+    with one entry for each query, in the same order. Each entry is an object with
+    a ``status`` field and either a ``record`` or an ``error`` field.
+
+    If the request body is not a JSON list or has more than :const:`MAX_BATCH_QUERIES`
+    queries, render the ``400`` page.
+
+    See :func:`recordMatching`.
+    """
+    queries = flask.request.get_json(force=True, silent=True)
+    if not isinstance(queries, list):
+        error_message = "request body should be a JSON list of queries"
+        return flask.render_template('400.html', error_message=error_message), 400
+    if len(queries) > MAX_BATCH_QUERIES:
+        error_message = "too many queries: should be at most {0}".format(MAX_BATCH_QUERIES)
+        return flask.render_template('400.html', error_message=error_message), 400
+
+    recordIndex = getRecordIndexFromDb()
+
+    results = []
+    for query in queries:
+        if not isinstance(query, dict):
+            results.append({'status': 400, 'error': "query should be a JSON object"})
+            continue
+        args = {name: str(value) for name, value in query.items()}
+        record, error_message, error_code = recordMatching(args, recordIndex)
+        if record:
+            results.append({'status': 200, 'record': record})
         else:
-            return record[key]
-
-    elif getServerAPI() == ServerAPI.Girder_v1:
-        if key == 'os':
-            return record['meta']['os']
-        elif key == 'revision':
-            return record['meta']['revision']
-        elif key == 'date_creation':
-            return record['meta']['build_date']
-        elif key == 'checkoutdate':
-            return None  # Not supported
-        elif key == 'release':
-            return record['meta'].get('release', '')
-        elif key == 'submissiontype':
-            return 'release' if record['meta'].get('release') else 'nightly'
-        elif key == 'bitstream_id':
-            return record['_id']
-
-
-def getCleanedUpRecord(record):
+            results.append({'status': error_code, 'error': error_message})
+
+    return json.dumps(results)
+
+
+def renderedResponseKey():
+    """Return ``(mode, value, offset)`` tuple identifying the result of
+    :func:`recordsMatchingAllOSAndStability` for the arguments of ``flask.request``.
+
+    Other arguments do not affect the rendered response and are ignored. The offset
+    is converted to an integer if possible.
+    """
+    modeName, value = getMode()
+    offset = flask.request.args.get('offset', '0')
+    try:
+        offset = int(offset)
+    except ValueError:
+        pass
+    return (modeName, value, offset)
+
+
+def lookupRenderedResponse(recordIndex, key):
+    """Return dictionary cached by :func:`storeRenderedResponse` using ``key`` or ``None``.
+
+    Hits and misses are counted (see :const:`METRICS`).
+    """
+    rendered = recordIndex.renderedResponses.get(recordIndex.version, key)
+    METRICS.increment('slicer_download_rendered_cache_misses_total' if rendered is None
+                      else 'slicer_download_rendered_cache_hits_total')
+    return rendered
+
+
+def storeRenderedResponse(recordIndex, key, body):
+    """Return a dictionary holding the encoded ``body``, its gzip compressed variant and
+    the associated entity tag.
+
+    The dictionary is cached in ``recordIndex.renderedResponses`` using ``key``. Once
+    :const:`MAX_RENDERED_RESPONSES` entries are cached, the least recently used one is
+    discarded. Cached responses are discarded along with the index when the database
+    changes.
+    """
+    data = body.encode('utf-8')
+
+    # Setting mtime ensures the compressed data only depend on the body
+    buffer = io.BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode='wb', mtime=0) as fp:
+        fp.write(data)
+
+    rendered = {
+        'data': data,
+        'gzip_data': buffer.getvalue(),
+        'etag': hashlib.sha1(data).hexdigest()
+    }
+    recordIndex.renderedResponses.put(recordIndex.version, key, rendered)
+    return rendered
+
+
+def getRenderedResponse(recordIndex, rendered):
+    """Return response for a dictionary created using :func:`storeRenderedResponse`.
+
+    The gzip compressed variant is selected if accepted by the client with a non-zero
+    quality (``gzip;q=0`` refuses it). The response includes a strong ``ETag`` and a
+    ``Last-Modified`` header set to the modification time of the database. If the
+    request is conditional and the client copy is up to date, the status is set to
+    ``304``.
+    """
+    request = flask.request
+    if request.accept_encodings['gzip'] > 0:
+        response = app.response_class(rendered['gzip_data'])
+        response.headers['Content-Encoding'] = 'gzip'
+        response.set_etag(rendered['etag'] + '-gzip')
+    else:
+        response = app.response_class(rendered['data'])
+        response.set_etag(rendered['etag'])
+    response.vary.add('Accept-Encoding')
+    if recordIndex.lastModified is not None:
+        response.last_modified = recordIndex.lastModified
+    return response.make_conditional(request)
+
+
+def getRecordField(record, key):
+    """Return value associated with ``key``.
+
+    See :const:`SERVER_API_ADAPTER`.
+    """
+    return SERVER_API_ADAPTER.getField(record, key)
+
+
+def getCleanedUpRecord(record, adapter=SERVER_API_ADAPTER):
     """Return a dictionary generated from a raw database record.
 
     It includes new fields and more consistent names.
 
-    See :func:`getVersion` and :func:`getLocalBitstreamURL`.
+    See :const:`SERVER_API_ADAPTER`, :func:`getVersion` and :func:`getLocalBitstreamURL`.
     """
     if not record:
         return None
 
-    cleaned = {}
-
-    if getServerAPI() == ServerAPI.Midas_v1:
-
-        for field in (
-            'arch',
-            'revision',
-            'os',
-            'codebase',
-            'name',
-            'package'
-        ):
-            cleaned[field] = record[field]
-
-        cleaned['build_date'] = record['date_creation']
-        cleaned['build_date_ymd'] = cleaned['build_date'].split(' ')[0]
-        cleaned['checkout_date'] = record['checkoutdate']
-        cleaned['checkout_date_ymd'] = cleaned['checkout_date'].split(' ')[0]
-
-        cleaned['product_name'] = record['productname']
-        cleaned['stability'] = 'release' if record['release'] else 'nightly'
-        cleaned['size'] = record['bitstreams'][0]['size']
-        cleaned['md5'] = record['bitstreams'][0]['md5']
-        cleaned['version'] = getVersion(record)
-        cleaned['download_url'] = getLocalBitstreamURL(record)
-
-    if getServerAPI() == ServerAPI.Girder_v1:
-
-        cleaned['arch'] = record['meta']['arch']
-        cleaned['revision'] = record['meta']['revision']
-        cleaned['os'] = record['meta']['os']
-        cleaned['codebase'] = None  # Not supported
-        cleaned['name'] = record['name']
-        cleaned['package'] = None  # Not supported
-
-        cleaned['build_date'] = record['meta']['build_date']
-        cleaned['build_date_ymd'] = dateutil.parser.parse(record['meta']['build_date']).strftime("%Y-%m-%d")
-        cleaned['checkout_date'] = None  # Not supported
-        cleaned['checkout_date_ymd'] = None  # Not supported
-
-        cleaned['product_name'] = record['meta']['baseName']
-        cleaned['stability'] = 'release' if getRecordField(record, 'release') else 'nightly'
-        cleaned['size'] = record['size']
-        cleaned['md5'] = None  # Not supported
-        cleaned['version'] = getVersion(record)
-        cleaned['download_url'] = getLocalBitstreamURL(record)
+    cleaned = adapter.getCleanedUpRecord(record)
+    cleaned['download_url'] = getLocalBitstreamURL(record, adapter)
 
     return cleaned
 
 
-def getLocalBitstreamURL(record):
+def getLocalBitstreamURL(record, adapter=SERVER_API_ADAPTER):
     """Given a record, return the URL of the local bitstream
     (e.g., https://download.slicer.org/bitstream/XXXXX )"""
-    bitstreamId = getRecordField(record, 'bitstream_id')
+    bitstreamId = adapter.getField(record, 'bitstream_id')
 
     downloadURL = '{0}/{1}'.format(LOCAL_BITSTREAM_PATH, bitstreamId)
     return downloadURL
 
 
-def getMode():
+def getMode(args=None):
     """Convenience function returning the mode name and value extracted
-    from ``flask.request``.
+    from ``args`` or from ``flask.request`` arguments if not specified.
 
     If no mode parameter was found (see :const:`MODE_CHOICES`), it returns
     ``None, None``.
     """
-    request = flask.request
+    if args is None:
+        args = flask.request.args
 
     modeDict = {}
     for name in MODE_CHOICES:
-        value = request.args.get(name, None)
+        value = args.get(name, None)
         if value is not None:
             modeDict[name] = value
 
@@ -270,37 +396,80 @@ def getMode():
 
 def getSupportedMode():
     """Return list of mode supported by the current server API."""
-    return {
-        ServerAPI.Midas_v1: MODE_CHOICES,
-        ServerAPI.Girder_v1: list(set(MODE_CHOICES) - set(['checkout-date']))
-    }[getServerAPI()]
+    return SUPPORTED_MODE_CHOICES
 
 
-def recordMatching():
-    """High level function for getting the best record matching specific criteria including OS."""
-    request = flask.request
-    revisionRecords = getRecordsFromDb()
+def recordMatching(args=None, recordIndex=None):
+    """High level function for getting the best record matching specific criteria including OS.
+
+    Criteria are read from ``args`` or from ``flask.request`` arguments if not specified.
+
+    If ``recordIndex`` is not specified, :func:`getRecordIndexFromDb` is used.
+
+    Results, including errors, are cached in :const:`RESOLUTION_CACHE` using
+    :func:`normalizedQuery` as key.
+    """
+    if args is None:
+        args = flask.request.args
+    if recordIndex is None:
+        recordIndex = getRecordIndexFromDb()
+
+    key = normalizedQuery(args)
+    result = RESOLUTION_CACHE.get(recordIndex.version, key)
+    if result is None:
+        result = resolveRecordMatching(args, recordIndex)
+        RESOLUTION_CACHE.put(recordIndex.version, key, result)
+    return result
+
+
+def normalizedQuery(args):
+    """Return ``(os, stability, mode, value, offset)`` tuple identifying the result of
+    :func:`recordMatching` for ``args``.
+
+    Default stability and mode are made explicit and the offset is converted to an
+    integer if possible.
+    """
+    modeName, value = getMode(args)
+    stability = args.get('stability', 'any' if modeName == 'revision' else 'release')
+    offset = args.get('offset', '0')
+    try:
+        offset = int(offset)
+    except ValueError:
+        pass
+    return (args.get('os'), stability, modeName, value, offset)
 
-    operatingSystem = request.args.get('os')  # may generate BadRequest if not present
+
+def resolveRecordMatching(args, recordIndex):
+    """Return the best record matching criteria read from ``args`` along with the
+    error message and status code.
+
+    See :func:`recordMatching`.
+    """
+    operatingSystem = args.get('os')  # may generate BadRequest if not present
     if operatingSystem not in SUPPORTED_OS_CHOICES:
         return None, 'unknown os "{0}": should be one of {1}'.format(operatingSystem, SUPPORTED_OS_CHOICES), 400
 
-    offset = int(request.args.get('offset', '0'))
+    try:
+        offset = int(args.get('offset', '0'))
+    except ValueError:
+        return None, 'bad offset "{0}": should be an integer'.format(args.get('offset')), 400
 
-    modeName, value = getMode()
+    modeName, value = getMode(args)
     if modeName is None:
         return None, "invalid or ambiguous mode: should be one of {0}".format(MODE_CHOICES), 400
     if modeName not in getSupportedMode():
         return None, "unsupported mode: should be one of {0}".format(getSupportedMode()), 400
 
     defaultStability = 'any' if modeName == 'revision' else 'release'
-    stability = request.args.get('stability', defaultStability)
+    stability = args.get('stability', defaultStability)
 
     if stability not in STABILITY_CHOICES:
         return None, "bad stability {0}: should be one of {1}".format(stability, STABILITY_CHOICES), 400
 
-    record = getBestMatching(revisionRecords, operatingSystem, stability, modeName, value, offset)
-    cleaned = getCleanedUpRecord(record)
+    try:
+        cleaned = getBestMatching(recordIndex, operatingSystem, stability, modeName, value, offset)
+    except ValueError:
+        return None, 'bad {0} "{1}": should be an integer'.format(modeName, value), 400
 
     if not cleaned:
         return None, "no matching revision for given parameters", 404
@@ -308,14 +477,21 @@ def recordMatching():
     return cleaned, None, 200
 
 
-def recordsMatchingAllOSAndStability():
+def recordsMatchingAllOSAndStability(recordIndex=None):
     """High level function returning all records matching search criteria,
-    for all OS and stability choices."""
+    for all OS and stability choices.
+
+    If ``recordIndex`` is not specified, :func:`getRecordIndexFromDb` is used.
+    """
 
     request = flask.request
-    revisionRecords = getRecordsFromDb()
+    if recordIndex is None:
+        recordIndex = getRecordIndexFromDb()
 
-    offset = int(request.args.get('offset', '0'))
+    try:
+        offset = int(request.args.get('offset', '0'))
+    except ValueError:
+        return None, 'bad offset "{0}": should be an integer'.format(request.args.get('offset')), 400
 
     modeName, value = getMode()
     if modeName is None:
@@ -324,179 +500,669 @@ def recordsMatchingAllOSAndStability():
         return None, "unsupported mode: should be one of {0}".format(getSupportedMode()), 400
 
     results = {}
-    for operatingSystem in SUPPORTED_OS_CHOICES:
-        osResult = {}
-        for stability in ('release', 'nightly'):
-            record = getBestMatching(revisionRecords, operatingSystem, stability, modeName, value, offset)
-            osResult[stability] = getCleanedUpRecord(record)
-        results[operatingSystem] = osResult
+    try:
+        for operatingSystem in SUPPORTED_OS_CHOICES:
+            osResult = {}
+            for stability in ('release', 'nightly'):
+                osResult[stability] = getBestMatching(
+                    recordIndex, operatingSystem, stability, modeName, value, offset)
+            results[operatingSystem] = osResult
+    except ValueError:
+        return None, 'bad {0} "{1}": should be an integer'.format(modeName, value), 400
 
     return results, None, 200
 
 
+class ResolutionCache:
+    """Bounded cache of :func:`recordMatching` results discarding the least recently
+    used entries. It is also used to cache the responses rendered from each record
+    index (see :func:`storeRenderedResponse`).
+
+    Entries are associated with the version of the record index they were computed
+    from (see :class:`RecordsLoader`). All the entries are discarded as soon as a
+    different version is requested. Errors (e.g ``400`` or ``404``) are cached as
+    well.
+
+    The number of ``hits`` and ``misses`` is counted for the whole process lifetime.
+    """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._version = None
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version, key):
+        """Return result associated with ``version`` and ``key`` or ``None``."""
+        with self._lock:
+            if version != self._version:
+                self._entries.clear()
+                self._version = version
+            result = self._entries.get(key)
+            if result is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return result
+
+    def put(self, version, key, result):
+        """Associate ``result`` with ``version`` and ``key``."""
+        with self._lock:
+            if version != self._version:
+                return
+            self._entries[key] = result
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        """Return dictionary with the number of hits, misses and cached entries."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._entries),
+                'maxSize': self.maxSize
+            }
+
+
+RESOLUTION_CACHE = ResolutionCache(MAX_RESOLVED_QUERIES)
+
+
 # query matching functions
-def matchOS(operatingSystem):
-    return lambda record: getRecordField(record, 'os') == operatingSystem
-
-
-def matchExactRevision(rev):
-    def match(record):
-        return int(rev) == int(getRecordField(record, 'revision'))
-    return match
-
-
-def matchClosestRevision(rev):
-    def match(record):
-        return int(rev) >= int(getRecordField(record, 'revision'))
-    return match
-
-
-def matchDate(dt, dateType):
-    def match(record):
-        if dateType == 'date':
-            dateString = getRecordField(record, 'date_creation')
-        elif dateType == 'checkout-date':
-            dateString = getRecordField(record, 'checkoutdate')
-        if not dateString:
-            return False
-        justDateString = dateString.split(' ')[0]  # drop time
-        return dt >= justDateString
-    return match
-
-
-def matchVersion(version):
-    def match(record):
-        record_version = getVersion(record)
-        if not record_version:
-            return False
-        record_version_parts = record_version.split('.')
-        version_parts = version.split('.')
-        for index in range(0, len(version_parts)):
-            if record_version_parts[index] != version_parts[index]:
-                return False
-        return True
-    return match
-
-
-def matchStability(stability):
+def versionPrefixes(version):
+    """Return the list of prefixes made of the first components of ``version``.
+
+    For example, ``4.11.20210226`` is associated with ``4``, ``4.11`` and ``4.11.20210226``.
+    If ``version`` is empty, an empty list is returned.
+    """
+    if not version:
+        return []
+    parts = version.split('.')
+    return ['.'.join(parts[:count]) for count in range(1, len(parts) + 1)]
+
+
+def matchStability(stability, adapter=SERVER_API_ADAPTER):
     if stability == 'nightly':
-        return lambda record: getRecordField(record, 'submissiontype') == 'nightly'
+        return lambda record: adapter.getField(record, 'submissiontype') == 'nightly'
     if stability == 'release':
-        return lambda record: getRecordField(record, 'release') != ""
+        return lambda record: adapter.getField(record, 'release') != ""
 
     return lambda record: True
 
+
 # composite field getters
+def getVersion(record):
+    """Extract version information from record.
 
-# this looks ugly because we need to be able to accept versions like:
-# 4.5.0, 4.5.0-1, 4.5.0-rc2, 4.5.0-gamma, and so forth
+    See :meth:`slicer_download.RecordAdapter.getVersion` and :const:`SERVER_API_ADAPTER`.
+    """
+    return SERVER_API_ADAPTER.getVersion(record)
 
 
-VersionWithDateRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
-VersionRE = re.compile(r'^[A-z]+-([-\d.a-z]+)-(macosx|linux|win+)')
-VersionFullRE = re.compile(r'^([-\d.a-z]+)-(\d{4}-\d{2}-\d{2})')
+def dateKey(dateString):
+    """Return the date part of ``dateString`` used when matching records by date.
 
+    The time is dropped and ``None`` is returned if ``dateString`` is empty.
+    """
+    if not dateString:
+        return None
+    return dateString.split(' ')[0]  # drop time
+
+
+def bisectDescending(values, x):
+    """Return the first index ``i`` such that ``values[i] <= x``.
+
+    ``values`` is expected to be sorted in non-increasing order. If all values are
+    greater than ``x``, ``len(values)`` is returned.
+    """
+    lo, hi = 0, len(values)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if values[mid] <= x:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
 
-def getVersion(record):
-    """Extract version information from record.
 
-    If ``release`` key is found, returns associated value.
+# Prefix minimum associated with records not having any date. It compares greater
+# than any date string.
+_NO_DATE = chr(0x10ffff)
 
-    Otherwise it returns the version extracted from the value associated
-    with the ``name`` key for :const:`ServerAPI.Midas_v1` or the ``meta.version`
-    key for :const:`ServerAPI.Girder_v1`.
 
-    For :const:`ServerAPI.Midas_v1`, extraction of the version is attempted using
-    first :const:`VersionWithDateRE` and then :const:`VersionRE`.
+def prefixMinimum(values):
+    """Return the list of running minimum of ``values``, ignoring ``None`` entries."""
+    return list(itertools.accumulate([_NO_DATE if value is None else value for value in values], min))
 
-    For :const:`ServerAPI.Girder_v1`, extraction of the version is attempted using
-    first :const:`VersionFullRE`.
 
-    If value associated with the selected key does not match any of the regular
-    expressions, it returns ``None``.
+def concatenatePrefixMinimums(first, second):
+    """Return the running minimum of the concatenated values given the running
+    minimums ``first`` and ``second`` of each part (see :func:`prefixMinimum`)."""
+    if not first:
+        return second
+    minimum = first[-1]
+    count = bisectDescending(second, minimum)
+    return first + [minimum] * count + second[count:]
+
+
+# Stabilities matched by a record depending on whether it is a release and a nightly
+# build (see recordIndexKeys). The tuples are shared by all the records.
+_RECORD_STABILITIES = {
+    (isRelease, isNightly): tuple(
+        stability for stability, matched in zip(STABILITY_CHOICES, (isRelease, isNightly, True)) if matched)
+    for isRelease in (False, True) for isNightly in (False, True)
+}
+
+
+def recordIndexKeys(record, adapter=SERVER_API_ADAPTER):
+    """Return ``(os, revision, stabilities, date, checkoutDate, version, buildDate)``
+    tuple used to index ``record`` (see :class:`RecordIndex`).
+
+    ``stabilities`` lists the :const:`STABILITY_CHOICES` matching the record (see
+    :func:`matchStability`), dates are converted using :func:`dateKey`. ``buildDate``
+    is the complete build date, records are sorted by decreasing ``revision`` and
+    ``buildDate`` (see :func:`recordSortKey`).
+    """
+    if isinstance(adapter, NormalizedRecordAdapter):
+        # columns of the packages table are read directly, skipping the field getters
+        return (record['os'],
+                record['revision'],
+                _RECORD_STABILITIES[(record['release'] != "", record['submissiontype'] == 'nightly')],
+                dateKey(record['build_date']),
+                dateKey(record['checkout_date']),
+                record['version'],
+                record['build_date'] or '')
+    # consistent with matchStability()
+    isRelease = adapter.getField(record, 'release') != ""
+    isNightly = adapter.getField(record, 'submissiontype') == 'nightly'
+    return (adapter.getField(record, 'os'),
+            int(adapter.getField(record, 'revision')),
+            _RECORD_STABILITIES[(isRelease, isNightly)],
+            dateKey(adapter.getField(record, 'date_creation')),
+            dateKey(adapter.getField(record, 'checkoutdate')),
+            adapter.getVersion(record),
+            adapter.getField(record, 'date_creation') or '')
+
+
+def recordSortKey(keys):
+    """Return key of the record associated with ``keys`` consistent with
+    ``order by revision desc,build_date desc`` once reversed.
+
+    See :func:`recordIndexKeys`.
     """
-    if getRecordField(record, 'release'):
-        return getRecordField(record, 'release')
+    return (keys[1], keys[6])
 
-    match = None
 
-    if getServerAPI() == ServerAPI.Midas_v1:
-        match = VersionWithDateRE.match(record['name'])
-        if not match:
-            match = VersionRE.match(record['name'])
+# Version of the index sections saved in snapshot files. It should be incremented
+# whenever the content of RecordIndex buckets changes.
+SNAPSHOT_LAYOUT = 3
 
-    elif getServerAPI() == ServerAPI.Girder_v1:
-        match = VersionFullRE.match(record['meta']['version'])
 
-    if not match:
-        return None
-    return match.group(1)
-
-
-def allPass(predlist):
-    """Returns a function that evaluates each predicate in a list given an argument,
-    and returns True if all pass, otherwise False."""
-    def evaluate(x):
-        for pred in predlist:
-            if not pred(x):
-                return False
-        return True
-    return evaluate
-
-
-def getBestMatching(revisionRecords, operatingSystem, stability, mode, modeArg, offset):
-    """Return best matching record.
-    """
-    osRecords = list(filter(matchOS(operatingSystem), revisionRecords))
-
-    selectors = [matchStability(stability)]
-
-    # now, do either version, date, or revision
-    if mode == 'version':
-        selectors.append(matchVersion(modeArg))
-    elif mode == 'revision':
-        selectors.append(matchExactRevision(modeArg))
-    elif mode == 'closest-revision':
-        selectors.append(matchClosestRevision(modeArg))
-    elif mode == 'date':
-        selectors.append(matchDate(modeArg, 'date'))
-    elif mode == 'checkout-date':
-        selectors.append(matchDate(modeArg, 'checkout-date'))
-    else:
+class RecordIndex:
+    """Index of records grouped by operating system and stability.
+
+    Records are expected to be sorted by decreasing revision and build date (see
+    :func:`getRecordsFromDb`). For each operating system and stability (see
+    :const:`STABILITY_CHOICES`), the index keeps the positions of the associated
+    records along with sorted keys allowing ``revision``, ``closest-revision``,
+    ``date`` and ``checkout-date`` lookups to be done using binary searches.
+
+    ``version`` and ``lastModified`` identify the database content the index was
+    created from (see :class:`RecordsLoader`). ``publishedVersion`` is the version
+    stamped by ``slicer_getbuildinfo`` if any.
+
+    For each operating system, records having the same revision are grouped so that
+    an ``offset`` can be applied to the matching record in constant time.
+
+    Since records are sorted by revision and not by date, the date keys are running
+    minimums: the first record built on or before a given date is also the first
+    record whose running minimum is on or before that date.
+
+    For ``version`` lookups, each bucket maps the sorted version prefixes (see
+    :func:`versionPrefixes`) to the first record having that prefix.
+
+    Positions and indices stored in the index are counted from the end of the
+    associated lists (they are negative). Records sorting before all the others can
+    then be added without changing the existing entries (see :meth:`updated`).
+
+    The keys of each record (see :func:`recordIndexKeys`) are kept in ``recordKeys``.
+    If ``recordKeys`` is specified, the keys are not computed again. This allows
+    the index of records loaded incrementally to be created without accessing the
+    fields of the records already loaded (see :class:`RecordsLoader`).
+
+    Cleaned up records (see :func:`getCleanedUpRecord`) are computed at most once
+    per index and stored next to the raw records (see :meth:`cleanedRecord`).
+
+    Fields of the records are accessed using ``adapter`` (see
+    :class:`slicer_download.RecordAdapter`).
+
+    The index may be saved into a snapshot file shared between processes (see
+    :meth:`writeSnapshot` and :class:`SharedRecordIndex`).
+    """
+
+    def __init__(self, records, version=None, lastModified=None, adapter=SERVER_API_ADAPTER, recordKeys=None):
+        self.records = records
+        self.version = version
+        self.publishedVersion = None
+        self.lastModified = lastModified
+        self.adapter = adapter
+        self.recordCount = len(records)
+        if recordKeys is None:
+            recordKeys = [recordIndexKeys(record, adapter) for record in records]
+        self.recordKeys = recordKeys
+        self.revisions = [keys[1] for keys in recordKeys]
+        self.cleanedRecords = [None] * len(records)
+        self.renderedResponses = ResolutionCache(MAX_RENDERED_RESPONSES)
+
+        # Positions of all the records associated with each operating system
+        osPositions = {}
+        for position, keys in enumerate(recordKeys, -len(recordKeys)):
+            osPositions.setdefault(keys[0], []).append(position)
+
+        self.osTables = {}
+        self.buckets = {}
+        for operatingSystem, positions in osPositions.items():
+            self.osTables[operatingSystem] = self._createOSTable(positions)
+            for stability, bucket in self._createBuckets(positions).items():
+                self.buckets[(operatingSystem, stability)] = bucket
+
+    def updated(self, replacements, newRecords, newRecordKeys, version=None, lastModified=None):
+        """Return index of ``newRecords`` followed by the records of this index.
+
+        ``replacements`` maps positions to records replacing the ones found in this
+        index, their keys are expected to be the same (see :func:`recordIndexKeys`).
+        ``newRecords`` are expected to sort before all the records of this index.
+
+        Since stored positions and indices are counted from the end, the entries of
+        this index are copied as is: only the entries of ``newRecords`` are computed.
+        """
+        head = RecordIndex(newRecords, adapter=self.adapter, recordKeys=newRecordKeys)
+        recordIndex = copy.copy(self)
+        recordIndex.records = newRecords + self.records
+        recordIndex.version = version
+        recordIndex.publishedVersion = None
+        recordIndex.lastModified = lastModified
+        recordIndex.recordCount = len(recordIndex.records)
+        recordIndex.recordKeys = newRecordKeys + self.recordKeys
+        recordIndex.revisions = head.revisions + self.revisions
+        recordIndex.cleanedRecords = head.cleanedRecords + self.cleanedRecords
+        recordIndex.renderedResponses = ResolutionCache(MAX_RENDERED_RESPONSES)
+        for position, record in replacements.items():
+            recordIndex.records[position] = record
+            recordIndex.cleanedRecords[position] = None
+
+        recordIndex.osTables = dict(self.osTables)
+        recordIndex.buckets = dict(self.buckets)
+        for operatingSystem, headTable in head.osTables.items():
+            osTable = self.osTables.get(operatingSystem, dict.fromkeys(headTable, []))
+            osCount = len(osTable['positions'])
+            # the last new group and the first existing one may have the same revision
+            merged = osTable['groupRevisions'][:1] == headTable['groupRevisions'][-1:]
+            groupCount = len(osTable['groupFirst']) - merged
+            headGroupLast = headTable['groupLast'][:len(headTable['groupLast']) - merged]
+            recordIndex.osTables[operatingSystem] = {
+                'positions': [position - self.recordCount for position in headTable['positions']]
+                + osTable['positions'],
+                'groups': [group - groupCount for group in headTable['groups']] + osTable['groups'],
+                'groupRevisions': headTable['groupRevisions'] + osTable['groupRevisions'][merged:],
+                'groupFirst': [osIndex - osCount for osIndex in headTable['groupFirst']]
+                + osTable['groupFirst'][merged:],
+                'groupLast': [osIndex - osCount for osIndex in headGroupLast] + osTable['groupLast']
+            }
+            for stability in STABILITY_CHOICES:
+                headBucket = head.buckets[(operatingSystem, stability)]
+                bucket = self.buckets.get((operatingSystem, stability), dict.fromkeys(headBucket, []))
+                if not headBucket['positions'] and (operatingSystem, stability) in self.buckets:
+                    continue
+                bucketCount = len(bucket['positions'])
+                versionKeys = list(bucket['versionKeys'])
+                versionIndices = list(bucket['versionIndices'])
+                for prefix, index in zip(headBucket['versionKeys'], headBucket['versionIndices']):
+                    keyIndex = bisect_left(versionKeys, prefix)
+                    if keyIndex < len(versionKeys) and versionKeys[keyIndex] == prefix:
+                        versionIndices[keyIndex] = index - bucketCount
+                    else:
+                        versionKeys.insert(keyIndex, prefix)
+                        versionIndices.insert(keyIndex, index - bucketCount)
+                recordIndex.buckets[(operatingSystem, stability)] = {
+                    'positions': [position - self.recordCount for position in headBucket['positions']]
+                    + bucket['positions'],
+                    'osIndices': [osIndex - osCount for osIndex in headBucket['osIndices']] + bucket['osIndices'],
+                    'revisions': headBucket['revisions'] + bucket['revisions'],
+                    'date': concatenatePrefixMinimums(headBucket['date'], bucket['date']),
+                    'checkout-date': concatenatePrefixMinimums(headBucket['checkout-date'], bucket['checkout-date']),
+                    'versionKeys': versionKeys,
+                    'versionIndices': versionIndices
+                }
+        return recordIndex
+
+    def cleanedRecord(self, position):
+        """Return cleaned up record associated with ``position`` or ``None``.
+
+        See :func:`getCleanedUpRecord`.
+        """
+        if position is None:
+            return None
+        cleaned = self.cleanedRecords[position]
+        if cleaned is None:
+            cleaned = getCleanedUpRecord(self.records[position], self.adapter)
+            self.cleanedRecords[position] = cleaned
+        return cleaned
+
+    def writeSnapshot(self, filepath, signature):
+        """Write index and cleaned up records into snapshot file ``filepath``.
+
+        ``signature`` identifies the database content the index was created from.
+
+        See :func:`slicer_download_server.snapshot.writeSnapshot`.
+        """
+        sections = {
+            'revisions': self.revisions,
+            'cleaned': [json.dumps(self.cleanedRecord(position)) for position in range(len(self.records))]
+        }
+        osSections = {}
+        for operatingSystem, osTable in self.osTables.items():
+            fieldSections = {}
+            for field, values in osTable.items():
+                fieldSections[field] = 'os:{0}:{1}'.format(len(osSections), field)
+                sections[fieldSections[field]] = values
+            osSections[operatingSystem] = fieldSections
+        bucketSections = []
+        for (operatingSystem, stability), bucket in self.buckets.items():
+            fieldSections = {}
+            for field, values in bucket.items():
+                fieldSections[field] = 'bucket:{0}:{1}'.format(len(bucketSections), field)
+                sections[fieldSections[field]] = values
+            bucketSections.append([operatingSystem, stability, fieldSections])
+
+        header = {
+            'layout': SNAPSHOT_LAYOUT,
+            'signature': signature,
+            'lastModified': self.lastModified,
+            'osTables': osSections,
+            'buckets': bucketSections
+        }
+        snapshot.writeSnapshot(filepath, header, sections)
+
+    def _createOSTable(self, osPositions):
+        """Return positions of the records associated with an operating system along with
+        the groups of consecutive records having the same revision.
+
+        For each position, ``groups`` gives the index of its group. For each group,
+        ``groupFirst`` and ``groupLast`` give the first and last index in ``positions``.
+        """
+        revisions = [self.revisions[position] for position in osPositions]
+        groupFirst = [osIndex for osIndex in range(-len(revisions), 0)
+                      if osIndex == -len(revisions) or revisions[osIndex] != revisions[osIndex - 1]]
+        groupLast = [osIndex - 1 for osIndex in groupFirst[1:]] + [-1][:len(groupFirst)]
+        groups = []
+        for group, (first, last) in enumerate(zip(groupFirst, groupLast), -len(groupFirst)):
+            groups.extend(itertools.repeat(group, last - first + 1))
+        return {
+            'positions': osPositions,
+            'groups': groups,
+            'groupRevisions': [revisions[osIndex] for osIndex in groupFirst],
+            'groupFirst': groupFirst,
+            'groupLast': groupLast
+        }
+
+    def _createBuckets(self, osPositions):
+        """Return dictionary associating each stability with the bucket of the records
+        of an operating system.
+
+        The buckets are created from the keys of the records (see :func:`recordIndexKeys`).
+        Version prefixes are only computed once for each version found in a bucket.
+        """
+        recordKeys = self.recordKeys
+        buckets = {}
+        for stability in STABILITY_CHOICES:
+            osIndices = [osIndex for osIndex, position in enumerate(osPositions, -len(osPositions))
+                         if stability in recordKeys[position][2]]
+            positions = [osPositions[osIndex] for osIndex in osIndices]
+            keys = [recordKeys[position] for position in positions]
+
+            # index of the first record of each version
+            versions = [recordKey[5] for recordKey in keys]
+            firstIndices = dict(zip(reversed(versions), range(-1, -len(versions) - 1, -1)))
+            versionIndices = {}
+            for version, index in firstIndices.items():
+                for prefix in versionPrefixes(version):
+                    if index < versionIndices.get(prefix, 0):
+                        versionIndices[prefix] = index
+
+            bucket = {
+                'positions': positions,
+                'osIndices': osIndices,
+                'revisions': [recordKey[1] for recordKey in keys],
+                'date': prefixMinimum([recordKey[3] for recordKey in keys]),
+                'checkout-date': prefixMinimum([recordKey[4] for recordKey in keys]),
+                'versionKeys': sorted(versionIndices)
+            }
+            bucket['versionIndices'] = [versionIndices[prefix] for prefix in bucket['versionKeys']]
+            buckets[stability] = bucket
+        return buckets
+
+    def _findInBucket(self, bucket, mode, modeArg):
+        """Return index within ``bucket`` of the first record matching ``mode``."""
+        if mode in ('revision', 'closest-revision'):
+            rev = int(modeArg)
+            index = bisectDescending(bucket['revisions'], rev)
+            if index == len(bucket['revisions']):
+                return None
+            if mode == 'revision' and bucket['revisions'][index] != rev:
+                return None
+            return index
+
+        if mode in ('date', 'checkout-date'):
+            index = bisectDescending(bucket[mode], modeArg)
+            return index if index < len(bucket[mode]) else None
+
+        if mode == 'version':
+            index = bisect_left(bucket['versionKeys'], modeArg)
+            if index == len(bucket['versionKeys']) or bucket['versionKeys'][index] != modeArg:
+                return None
+            return bucket['versionIndices'][index]
+
         app.logger.error("unknown mode {0}".format(mode))
         return None
 
-    matcher = allPass(selectors)
+    def bestMatching(self, operatingSystem, stability, mode, modeArg, offset):
+        """Return position of the best matching record or ``None``.
 
-    matchingRecordIndex = -1
-    for index, osRecord in enumerate(osRecords):
-        if matcher(osRecord):
-            matchingRecordIndex = index
-            break
+        See :func:`getBestMatching`.
+        """
+        bucket = self.buckets.get((operatingSystem, stability))
+        if bucket is None:
+            return None
 
-    if matchingRecordIndex == -1:
-        matchingRecord = None
-    else:
-        if offset < 0:
-            # an offset < 0 looks backward in time, or forward in the list
-            g = groupby(osRecords[matchingRecordIndex:], key=lambda record: int(getRecordField(record, 'revision')))
-            try:
-                o = next(islice(g, -offset, -offset + 1))
-                matchingRecord = list(o[1])[0]
-            except StopIteration:  # no match or stepped off the end of the list
-                matchingRecord = None
-        elif offset > 0:
-            # look forward in time for the latest build of a particular rev, so
-            # flip list
-            g = groupby(osRecords[matchingRecordIndex:0:-1], key=lambda record: int(getRecordField(record, 'revision')))
-            try:
-                o = next(islice(g, offset, offset + 1))
-                matchingRecord = list(o[1])[-1]
-            except StopIteration:  # no match of stepped off the end of the list
-                matchingRecord = None
-        else:
-            matchingRecord = osRecords[matchingRecordIndex]
-    return matchingRecord
+        index = self._findInBucket(bucket, mode, modeArg)
+        if index is None:
+            return None
+
+        osTable = self.osTables[operatingSystem]
+        osIndex = bucket['osIndices'][index]
+
+        if offset != 0:
+            # an offset < 0 looks backward in time, or forward in the list. An offset > 0
+            # looks forward in time for the latest build of a particular revision.
+            group = osTable['groups'][osIndex] - offset
+            if not -len(osTable['groupFirst']) <= group < 0:
+                return None  # stepped off the end of the list
+            osIndex = osTable['groupFirst'][group]
+
+        return osTable['positions'][osIndex]
+
+
+class SharedRecordIndex(RecordIndex):
+    """Index of records memory mapped from a snapshot file.
+
+    The snapshot file is written using :meth:`RecordIndex.writeSnapshot`. Since the
+    file is mapped read-only, the associated memory is shared between all the processes
+    using it. Raw records are not available, only cleaned up records are.
+    """
+
+    def __init__(self, filepath, version=None):
+        header, sections = snapshot.readSnapshot(filepath)
+        if header.get('layout') != SNAPSHOT_LAYOUT:
+            raise ValueError('%s has an outdated index layout' % filepath)
+        self.records = None
+        self.adapter = None
+        self.signature = header['signature']
+        self.version = version
+        self.publishedVersion = None
+        self.lastModified = header['lastModified']
+        self.revisions = sections['revisions']
+        self.recordCount = len(self.revisions)
+        self.cleanedRecords = {}
+        self.renderedResponses = ResolutionCache(MAX_RENDERED_RESPONSES)
+        self._cleanedData = sections['cleaned']
+
+        self.osTables = {}
+        for operatingSystem, fieldSections in header['osTables'].items():
+            self.osTables[operatingSystem] = {
+                field: sections[name] for field, name in fieldSections.items()}
+
+        self.buckets = {}
+        for operatingSystem, stability, fieldSections in header['buckets']:
+            self.buckets[(operatingSystem, stability)] = {
+                field: sections[name] for field, name in fieldSections.items()}
+
+    def cleanedRecord(self, position):
+        """Return cleaned up record associated with ``position`` or ``None``."""
+        if position is None:
+            return None
+        cleaned = self.cleanedRecords.get(position)
+        if cleaned is None:
+            cleaned = json.loads(self._cleanedData[position])
+            self.cleanedRecords[position] = cleaned
+        return cleaned
+
+
+class ConnectionPool:
+    """Pool of read-only connections to a database file.
+
+    At most ``size`` idle connections are kept. The ``datekey`` SQL function is
+    associated with each connection (see :func:`dateKey`).
+    """
+
+    def __init__(self, database_filepath, size=4):
+        self.database_filepath = database_filepath
+        self.size = size
+        self._connections = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        try:
+            database_connection = self._connections.get_nowait()
+        except queue.Empty:
+            database_connection = openDb(self.database_filepath, readonly=True)
+            database_connection.create_function('datekey', 1, dateKey)
+        try:
+            yield database_connection
+        finally:
+            if self._connections.qsize() < self.size:
+                self._connections.put(database_connection)
+            else:
+                database_connection.close()
+
+
+class SqlRecordIndex:
+    """Answer record queries using indexed SQL statements.
+
+    Contrary to :class:`RecordIndex`, records are kept in the database and only
+    the matching ones are loaded. This requires the ``os``, ``stability``, ``submissiontype``
+    and ``version`` columns added by ``slicer_getbuildinfo``.
+
+    The ``position`` of a record is its ``rowid``.
+    """
+
+    # SQL condition and parameters associated with each mode
+    MODE_CONDITIONS = {
+        'revision': ('revision = ?', lambda value: [int(value)]),
+        'closest-revision': ('revision <= ?', lambda value: [int(value)]),
+        'date': ('datekey(build_date) <= ?', lambda value: [value]),
+        'checkout-date': ('datekey(checkout_date) <= ?', lambda value: [value]),
+        'version': ("(version = ? or substr(version, 1, length(?) + 1) = ? || '.')", lambda value: [value] * 3)
+    }
+
+    def __init__(self, connectionPool, version=None, lastModified=None):
+        self.records = None
+        self.connectionPool = connectionPool
+        self.version = version
+        self.publishedVersion = None
+        self.lastModified = lastModified
+        self.renderedResponses = ResolutionCache(MAX_RENDERED_RESPONSES)
+        with self.connectionPool.connection() as database_connection:
+            self.recordCount = database_connection.execute('select count(1) from _').fetchone()[0]
+
+    def bestMatching(self, operatingSystem, stability, mode, modeArg, offset):
+        """Return ``rowid`` of the best matching record or ``None``.
+
+        See :meth:`RecordIndex.bestMatching`.
+        """
+        if mode not in self.MODE_CONDITIONS:
+            app.logger.error("unknown mode {0}".format(mode))
+            return None
+        condition, parameters = self.MODE_CONDITIONS[mode]
+        conditions = ['os = ?', condition]
+        parameters = [operatingSystem] + parameters(modeArg)
+        # consistent with matchStability()
+        if stability == 'release':
+            conditions.insert(1, "stability = 'release'")
+        elif stability == 'nightly':
+            conditions.insert(1, "submissiontype = 'nightly'")
+
+        with self.connectionPool.connection() as database_connection:
+            row = database_connection.execute(
+                'select rowid, revision from _ where {0} order by revision desc, build_date desc limit 1'.format(
+                    ' and '.join(conditions)), parameters).fetchone()
+            if row is None:
+                return None
+            rowid, revision = row
+            if offset == 0:
+                return rowid
+
+            # an offset < 0 looks backward in time, or forward in the list. An offset > 0
+            # looks forward in time for the latest build of a particular revision.
+            row = database_connection.execute(
+                'select distinct revision from _ where os = ? and revision {0} ? '
+                'order by revision {1} limit 1 offset ?'.format(
+                    '<' if offset < 0 else '>', 'desc' if offset < 0 else 'asc'),
+                [operatingSystem, revision, abs(offset) - 1]).fetchone()
+            if row is None:
+                return None  # stepped off the end of the list
+            row = database_connection.execute(
+                'select rowid from _ where os = ? and revision = ? order by build_date desc limit 1',
+                [operatingSystem, row[0]]).fetchone()
+        return row[0]
+
+    def cleanedRecord(self, position):
+        """Return cleaned up record associated with ``rowid`` or ``None``.
+
+        See :func:`getCleanedUpRecord`.
+        """
+        if position is None:
+            return None
+        with self.connectionPool.connection() as database_connection:
+            row = database_connection.execute('select record from _ where rowid = ?', [position]).fetchone()
+        if row is None:
+            return None
+        return getCleanedUpRecord(json.loads(row[0]))
+
+
+def getBestMatching(recordIndex, operatingSystem, stability, mode, modeArg, offset):
+    """Return cleaned up best matching record.
+
+    See :class:`RecordIndex`.
+    """
+    with serverTiming('match'):
+        position = recordIndex.bestMatching(operatingSystem, stability, mode, modeArg, offset)
+    with serverTiming('cleanup'):
+        return recordIndex.cleanedRecord(position)
 
 
 def dbFilePath():
@@ -529,7 +1195,7 @@ def dbFilePath():
             {
                 ServerAPI.Midas_v1: 'slicer-midas-records.sqlite',
                 ServerAPI.Girder_v1: 'slicer-girder-records.sqlite'
-            }[getServerAPI()]
+            }[SERVER_API_ADAPTER.serverAPI]
         )
 
     if not os.path.isabs(db_file):
@@ -538,39 +1204,604 @@ def dbFilePath():
         return db_file
 
 
+def snapshotFilePath():
+    """Return snapshot filepath used to share records between processes.
+
+    If a relative path is associated with either configuration entry or the environment
+    variable, ``app.root_path`` is prepended.
+
+    The filepath is set following these steps:
+
+    1. If set, returns value associated  with ``SNAPSHOT_FILE`` configuration entry.
+
+    2. If set, returns value associated with ``SLICER_DOWNLOAD_SNAPSHOT_FILE`` environment variable.
+
+    3. Returns :func:`dbFilePath()` with the ``.snapshot`` suffix appended.
+    """
+    if 'SNAPSHOT_FILE' in app.config:
+        snapshot_file = app.config['SNAPSHOT_FILE']
+    elif 'SLICER_DOWNLOAD_SNAPSHOT_FILE' in os.environ:
+        snapshot_file = os.environ["SLICER_DOWNLOAD_SNAPSHOT_FILE"]
+    else:
+        snapshot_file = dbFilePath() + '.snapshot'
+
+    if not os.path.isabs(snapshot_file):
+        return os.path.join(app.root_path, snapshot_file)
+    else:
+        return snapshot_file
+
+
 def getRecordsFromDb():
     """Return all records found in the database associated with :func:`dbFilePath()`.
 
-    List of records are cached using an application configuration entry identified
-    by ``_CACHED_RECORDS`` key.
+    If ``SHARED_SNAPSHOT`` configuration entry is set to True or ``QUERY_ENGINE``
+    is set to ``sql``, raw records are not loaded and ``None`` is returned.
+
+    See :func:`getRecordIndexFromDb`.
+    """
+    return getRecordIndexFromDb().records
+
 
-    See also :func:`openDb`.
+@contextmanager
+def garbageCollectionPaused():
+    """Disable the cyclic garbage collector within the block.
+
+    Loading records allocates hundreds of thousands of objects, none of which are part
+    of reference cycles. The collections triggered by these allocations would only
+    traverse them again and again.
     """
+    enabled = gc.isenabled()
+    gc.disable()
     try:
-        records = flask.current_app.config["_CACHED_RECORDS"]
-    except KeyError:
-        records = None
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class RecordsLoader:
+    """Load records from a database file and keep the associated :class:`RecordIndex`
+    up to date.
+
+    Changes are detected by comparing the identity, size and modification time of the
+    database file (and of its write-ahead log if any) along with the ``data_version``
+    reported by a persistent read-only connection. The latter changes whenever another
+    connection commits to the database, including updates leaving the number of
+    records unchanged.
+
+    When a change is detected, a single thread reloads the records while the other
+    threads keep using the current index. The new index is then swapped in at once.
+    Rows listed in the ``change_log`` table filled by ``slicer_getbuildinfo`` since
+    the previous load are merged into the current index without parsing the other
+    records again (see :meth:`_load`).
+
+    If the database has an up-to-date normalized ``packages`` table (see
+    ``slicer_getbuildinfo``), records are read from its typed columns instead of
+    parsing the JSON documents stored in the ``_`` table.
+
+    If ``snapshot_filepath`` is set, the index is shared between processes using a
+    snapshot file (see :class:`SharedRecordIndex`). The first process detecting
+    a change writes the snapshot while holding an exclusive lock on
+    ``<snapshot_filepath>.lock``, the other processes then map the new file.
+
+    If ``engine`` is set to ``sql``, records are not loaded and queries are answered
+    by the database (see :class:`SqlRecordIndex`).
+
+    Whether the database is updated in place using a write-ahead log or replaced by
+    an atomic rename (see ``slicer_getbuildinfo --publish``), readers never wait for
+    the writer: the persistent connection is re-opened when the file is replaced.
+    """
 
+    def __init__(self, database_filepath, snapshot_filepath=None, engine='memory'):
+        self.database_filepath = database_filepath
+        self.snapshot_filepath = snapshot_filepath
+        self.engine = engine
+        self.recordIndex = None
+        self._connection = None
+        self._connectionPool = None
+        self._loadedRows = None
+        self._fileIdentity = None
+        self._connectionLock = threading.Lock()
+        self._reloadLock = threading.Lock()
+
+    def currentSignature(self):
+        """Return value identifying the database file and its write-ahead log content.
+
+        Contrary to :meth:`currentVersion`, the value is the same for all processes.
+        """
+        if not os.path.isfile(self.database_filepath):
+            raise IOError(2, 'Database file %s does not exist', self.database_filepath)
+        stat = os.stat(self.database_filepath)
+        try:
+            walStat = os.stat(self.database_filepath + '-wal')
+            wal = (walStat.st_size, walStat.st_mtime_ns)
+        except FileNotFoundError:
+            wal = (0, 0)
+        return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns) + wal
+
+    def currentVersion(self):
+        """Return value identifying the current content of the database."""
+        signature = self.currentSignature()
+        with self._connectionLock:
+            fileIdentity = signature[:2]
+            if self._connection is None or fileIdentity != self._fileIdentity:
+                # database file was created or replaced
+                if self._connection is not None:
+                    self._connection.close()
+                self._connection = openDb(self.database_filepath, readonly=True)
+                self._connectionPool = ConnectionPool(self.database_filepath)
+                self._fileIdentity = fileIdentity
+            dataVersion = self._connection.execute('pragma data_version').fetchone()[0]
+        return signature + (dataVersion,)
+
+    def getRecordIndex(self):
+        """Return the :class:`RecordIndex` associated with the current database content.
+
+        If the database changed and another thread is already reloading it, the
+        current index is returned.
+        """
+        with serverTiming('db'):
+            version = self.currentVersion()
+        recordIndex = self.recordIndex
+        if recordIndex is not None and recordIndex.version == version:
+            return recordIndex
+
+        # Only wait for the reload if there is nothing to serve yet
+        if not self._reloadLock.acquire(blocking=recordIndex is None):
+            return recordIndex
+        try:
+            with serverTiming('load'):
+                self._reload()
+        finally:
+            self._reloadLock.release()
+        return self.recordIndex
+
+    def _reload(self):
+        """Load the index associated with the current database content unless another
+        thread did while the reload lock was being acquired."""
+        version = self.currentVersion()
+        if self.recordIndex is not None and self.recordIndex.version == version:
+            return
+        startTime = time.time()
+        if self.engine == 'sql' and self._hasIndexedColumns():
+            recordIndex = SqlRecordIndex(
+                self._connectionPool, version=version, lastModified=os.path.getmtime(self.database_filepath))
+        elif self.snapshot_filepath:
+            recordIndex = self._loadSharedSnapshot(version)
+        else:
+            recordIndex = self._load(version)
+        recordIndex.publishedVersion = self._publishedVersion()
+        self.recordIndex = recordIndex
+        duration = time.time() - startTime
+        METRICS.increment('slicer_download_reloads_total')
+        METRICS.set('slicer_download_reload_duration_seconds', duration)
+        app.logger.info("loaded %s version %s using %s in %.3fs" % (
+            self.database_filepath, recordIndex.publishedVersion, type(recordIndex).__name__, duration))
+
+    def _publishedVersion(self):
+        """Return version stored in the ``publication`` table by ``slicer_getbuildinfo``
+        or ``None`` if the table does not exist."""
+        with self._connectionLock:
+            try:
+                row = self._connection.execute('select version from publication').fetchone()
+            except sqlite3.OperationalError:
+                return None
+        return row[0] if row else None
+
+    def _hasIndexedColumns(self):
+        """Return True if the database has the columns required by :class:`SqlRecordIndex`."""
+        with self._connectionLock:
+            columns = [row[1] for row in self._connection.execute('pragma table_info(_)')]
+        if all(column in columns for column in ('os', 'stability', 'submissiontype', 'version')):
+            return True
+        app.logger.error("%s has no indexed columns: update it using slicer_getbuildinfo. "
+                         "Falling back to loading records in memory." % self.database_filepath)
+        return False
+
+    def _load(self, version):
+        """Return :class:`RecordIndex` associated with the current database content.
+
+        If the database file and the source table are the same as for the previous
+        load, only the rows listed in the ``change_log`` table since then are read
+        (see :meth:`_loadChanges`). Otherwise, or if the changes are not all listed
+        anymore, all the records are loaded.
+        """
+        lastModified = os.path.getmtime(self.database_filepath)
+        database_connection = openDb(self.database_filepath, readonly=True)
+        try:
+            # read the change log and the rows from the same snapshot of the database
+            database_connection.execute('begin')
+            table, adapter = self._recordSource(database_connection)
+            changeId = self._lastChangeId(database_connection)
+            previous = self._loadedRows
+            loaded = None
+            if (previous is not None and previous['fileIdentity'] == version[:2] and previous['table'] == table
+                    and previous['changeId'] is not None and changeId is not None
+                    and isinstance(self.recordIndex, RecordIndex) and self.recordIndex.records is not None):
+                loaded = self._loadChanges(database_connection, version, lastModified)
+            if loaded is None:
+                with garbageCollectionPaused():
+                    rows = self._readRows(database_connection.execute(
+                        'select rowid, * from {0} order by revision desc,build_date desc'.format(table)))
+                    rowids = [rowid for rowid, _ in rows]
+                    recordIndex = RecordIndex(
+                        [record for _, record in rows], version=version, lastModified=lastModified, adapter=adapter)
+                loaded = recordIndex, rowids, dict(zip(rowids, range(-len(rowids), 0)))
+        finally:
+            database_connection.close()
+
+        recordIndex, rowids, rowPositions = loaded
+        self._loadedRows = {
+            'fileIdentity': version[:2],
+            'table': table,
+            'changeId': changeId,
+            'rowids': rowids,
+            'rowPositions': rowPositions
+        }
+        return recordIndex
+
+    @staticmethod
+    def _lastChangeId(database_connection):
+        """Return id of the last entry of the ``change_log`` table filled by
+        ``slicer_getbuildinfo``, ``0`` if it is empty or ``None`` if it does not exist."""
+        try:
+            return database_connection.execute('select max(id) from change_log').fetchone()[0] or 0
+        except sqlite3.OperationalError:
+            return None
+
+    def _loadChanges(self, database_connection, version, lastModified):
+        """Return ``(recordIndex, rowids, rowPositions)`` updating the current index
+        with the rows changed since the previous load or ``None`` if all the records
+        should be loaded.
+
+        Only the keys of the changed rows are computed (see :func:`recordIndexKeys`),
+        the ones of the other records are reused. Rows updated without changing their
+        keys and rows sorting before all the loaded ones (e.g new builds) are added to
+        the current index (see :meth:`RecordIndex.updated`). Otherwise, the index is
+        created again from the cached keys.
+
+        ``rowPositions`` maps the rowid of each record to its position counted from
+        the end of the records.
+        """
+        previous = self._loadedRows
+        table = previous['table']
+        changes = [previous['changeId'], table]
+        firstChangeId = database_connection.execute('select min(id) from change_log').fetchone()[0]
+        if firstChangeId is not None and firstChangeId > previous['changeId'] + 1:
+            return None  # older entries were pruned
+
+        changedRowids = [rowid for rowid, in database_connection.execute(
+            'select distinct row from change_log where id > ? and table_name = ?', changes)]
+        rows = self._readRows(database_connection.execute(
+            '''select rowid, * from {0} where rowid in (select row from change_log where id > ? and table_name = ?)
+            order by revision desc,build_date desc'''.format(table), changes))
+        rowPositions = previous['rowPositions']
+        removedPositions = [rowPositions[rowid] for rowid in changedRowids if rowid in rowPositions]
+        count = database_connection.execute('select count(1) from {0}'.format(table)).fetchone()[0]
+        if count != len(rowPositions) - len(removedPositions) + len(rows):
+            return None  # rows changed without being listed
+
+        recordIndex = self.recordIndex
+        newKeys = [recordIndexKeys(record, recordIndex.adapter) for _, record in rows]
+        app.logger.info("loading %d changed records" % len(rows))
+
+        # rows updated in place are replaced by rows having the same keys
+        removedByKeys = {}
+        for position in removedPositions:
+            removedByKeys.setdefault(recordIndex.recordKeys[position], []).append(position)
+        replacements = {}
+        insertedRows = []
+        insertedKeys = []
+        for row, keys in zip(rows, newKeys):
+            positions = removedByKeys.get(keys)
+            if positions:
+                replacements[positions.pop()] = row
+            else:
+                insertedRows.append(row)
+                insertedKeys.append(keys)
+        deleted = any(removedByKeys.values())
+
+        if not deleted and (not insertedKeys or not recordIndex.recordKeys
+                            or recordSortKey(insertedKeys[-1]) >= recordSortKey(recordIndex.recordKeys[0])):
+            recordIndex = recordIndex.updated(
+                {position: record for position, (_, record) in replacements.items()},
+                [record for _, record in insertedRows], insertedKeys, version=version, lastModified=lastModified)
+            rowids = [rowid for rowid, _ in insertedRows] + previous['rowids']
+            rowPositions = rowPositions.copy()
+            for rowid in changedRowids:
+                rowPositions.pop(rowid, None)
+            for position, (rowid, _) in itertools.chain(
+                    replacements.items(), zip(range(-len(rowids), 0), insertedRows)):
+                rowids[position] = rowid
+                rowPositions[rowid] = position
+            return recordIndex, rowids, rowPositions
+
+        # merge the records left with the changed rows and index them again
+        removed = set(removedPositions)
+        keptEntries = (
+            (keys, rowid, record, cleaned) for position, keys, rowid, record, cleaned in zip(
+                itertools.count(-recordIndex.recordCount), recordIndex.recordKeys, previous['rowids'],
+                recordIndex.records, recordIndex.cleanedRecords)
+            if position not in removed)
+        changedEntries = [(keys, rowid, record, None) for keys, (rowid, record) in zip(newKeys, rows)]
+        entries = list(heapq.merge(
+            keptEntries, changedEntries, key=lambda entry: recordSortKey(entry[0]), reverse=True))
+        recordKeys, rowids, records, cleanedRecords = [[entry[field] for entry in entries] for field in range(4)]
+        recordIndex = RecordIndex(
+            records, version=version, lastModified=lastModified, adapter=recordIndex.adapter, recordKeys=recordKeys)
+        # Cleaned up records of the previous index are still valid
+        recordIndex.cleanedRecords = cleanedRecords
+        return recordIndex, rowids, dict(zip(rowids, range(-len(rowids), 0)))
+
+    @staticmethod
+    def _recordSource(database_connection):
+        """Return the table records should be read from along with the associated adapter.
+
+        The normalized ``packages`` table is only used if its schema version matches
+        :const:`slicer_download.NORMALIZED_SCHEMA_VERSION`.
+        """
+        hasNormalizedTable = database_connection.execute(
+            "select count(1) from sqlite_master where type = 'table' and name = 'packages'").fetchone()[0]
+        schemaVersion = database_connection.execute('pragma user_version').fetchone()[0]
+        if hasNormalizedTable and schemaVersion == NORMALIZED_SCHEMA_VERSION:
+            return 'packages', NormalizedRecordAdapter()
+        return '_', SERVER_API_ADAPTER
+
+    @staticmethod
+    def _readRows(cursor):
+        """Return list of ``(rowid, record)`` read from a ``select rowid, *`` query.
+
+        Rows of the ``_`` table are parsed from the ``record`` JSON document, rows of
+        the ``packages`` table are returned as dictionaries.
+        """
+        columns = [description[0] for description in cursor.description][1:]
+        if 'record' in columns:
+            recordColumn = columns.index('record') + 1
+            return [(row[0], json.loads(row[recordColumn])) for row in cursor]
+        return [(row[0], dict(zip(columns, row[1:]))) for row in cursor]
+
+    def _mapSharedSnapshot(self, version):
+        """Return :class:`SharedRecordIndex` if the snapshot file matches ``version``."""
+        try:
+            recordIndex = SharedRecordIndex(self.snapshot_filepath, version=version)
+        except FileNotFoundError:
+            return None
+        except ValueError as exc:
+            app.logger.warning("ignoring snapshot: %s" % exc)
+            return None
+        if recordIndex.signature != list(version[:-1]):
+            return None
+        return recordIndex
+
+    def _loadSharedSnapshot(self, version):
+        recordIndex = self._mapSharedSnapshot(version)
+        if recordIndex is not None:
+            return recordIndex
+
+        with open(self.snapshot_filepath + '.lock', 'a') as lockFile:
+            fcntl.flock(lockFile, fcntl.LOCK_EX)
+            # the snapshot may have been written while waiting for the lock
+            recordIndex = self._mapSharedSnapshot(version)
+            if recordIndex is None:
+                self._load(version).writeSnapshot(self.snapshot_filepath, list(version[:-1]))
+                app.logger.info("wrote snapshot %s" % self.snapshot_filepath)
+                recordIndex = self._mapSharedSnapshot(version)
+        return recordIndex
+
+
+_RECORDS_LOADER_LOCK = threading.Lock()
+
+
+def getRecordsLoader():
+    """Return :class:`RecordsLoader` associated with :func:`dbFilePath()`.
+
+    If ``SHARED_SNAPSHOT`` configuration entry is set to True, the loader shares
+    the records between processes using :func:`snapshotFilePath()`.
+
+    If ``QUERY_ENGINE`` configuration entry is set to ``sql``, queries are answered
+    by the database instead of loading records in memory (default ``memory``).
+
+    The loader is cached using an application configuration entry identified
+    by ``_RECORDS_LOADER`` key.
+    """
     database_filepath = dbFilePath()
-    app.logger.info("database_filepath: %s" % database_filepath)
-    if not os.path.isfile(database_filepath):
-        raise IOError(2, 'Database file %s does not exist', database_filepath)
-    database_connection = openDb(database_filepath)
-    cursor = database_connection.cursor()
+    snapshot_filepath = snapshotFilePath() if app.config.get('SHARED_SNAPSHOT', False) else None
+    engine = app.config.get('QUERY_ENGINE', 'memory')
+    with _RECORDS_LOADER_LOCK:
+        loader = flask.current_app.config.get("_RECORDS_LOADER")
+        if (loader is None
+                or loader.database_filepath != database_filepath
+                or loader.snapshot_filepath != snapshot_filepath
+                or loader.engine != engine):
+            app.logger.info("database_filepath: %s" % database_filepath)
+            loader = RecordsLoader(database_filepath, snapshot_filepath, engine)
+            flask.current_app.config["_RECORDS_LOADER"] = loader
+    return loader
+
+
+def getRecordIndexFromDb():
+    """Return :class:`RecordIndex` of all records found in the database associated
+    with :func:`dbFilePath()`.
+
+    See :func:`getRecordsLoader`.
+    """
+    return getRecordsLoader().getRecordIndex()
+
+
+def metricsDirPath():
+    """Return directory where the metrics of each process are written or ``None``.
+
+    If a relative path is associated with either configuration entry or the environment
+    variable, ``app.root_path`` is prepended.
 
-    # get record count
-    cursor.execute('select count(1) from _')
-    count = int(cursor.fetchone()[0])
+    The directory is set following these steps:
 
-    # load db if needed or count has changed
-    if records is None or count != len(records):
-        cursor.execute('select record from _ order by revision desc,build_date desc')
-        records = [json.loads(record[0]) for record in cursor.fetchall()]
-        flask.current_app.config["_CACHED_RECORDS"] = records
+    1. If set, returns value associated  with ``METRICS_DIR`` configuration entry.
 
-    database_connection.close()
+    2. If set, returns value associated with ``SLICER_DOWNLOAD_METRICS_DIR`` environment variable.
 
-    return records
+    3. Returns ``None``, only the metrics of the process answering the ``/metrics``
+       request are reported.
+    """
+    if 'METRICS_DIR' in app.config:
+        metrics_dir = app.config['METRICS_DIR']
+    elif 'SLICER_DOWNLOAD_METRICS_DIR' in os.environ:
+        metrics_dir = os.environ["SLICER_DOWNLOAD_METRICS_DIR"]
+    else:
+        return None
+
+    if not os.path.isabs(metrics_dir):
+        return os.path.join(app.root_path, metrics_dir)
+    else:
+        return metrics_dir
+
+
+# Metrics of the current process aggregated with the other processes sharing
+# the same metrics directory (see metricsDirPath)
+METRICS = metrics.Metrics(metricsDirPath())
+METRICS.describe('slicer_download_requests_total', metrics.COUNTER,
+                 'Number of requests by route, method and status.')
+METRICS.describe('slicer_download_request_duration_seconds', metrics.HISTOGRAM,
+                 'Request processing duration in seconds by route.')
+METRICS.describe('slicer_download_resolution_cache_hits_total', metrics.COUNTER,
+                 'Number of /find and /download queries answered by the resolution cache.')
+METRICS.describe('slicer_download_resolution_cache_misses_total', metrics.COUNTER,
+                 'Number of /find and /download queries resolved using the record index.')
+METRICS.describe('slicer_download_rendered_cache_hits_total', metrics.COUNTER,
+                 'Number of / and /findall responses served from the rendered responses cache.')
+METRICS.describe('slicer_download_rendered_cache_misses_total', metrics.COUNTER,
+                 'Number of / and /findall responses rendered.')
+METRICS.describe('slicer_download_reloads_total', metrics.COUNTER,
+                 'Number of record index loads.')
+METRICS.describe('slicer_download_reload_duration_seconds', metrics.GAUGE,
+                 'Duration in seconds of the last record index load.')
+METRICS.describe('slicer_download_records', metrics.GAUGE,
+                 'Number of records of the current record index.')
+METRICS.describe('slicer_download_snapshot_age_seconds', metrics.GAUGE,
+                 'Time in seconds since the database of the current record index was modified.')
+
+
+def collectMetrics():
+    """Update metrics maintained by :const:`RESOLUTION_CACHE` and the current
+    record index (see :class:`RecordsLoader`)."""
+    stats = RESOLUTION_CACHE.stats()
+    METRICS.set('slicer_download_resolution_cache_hits_total', stats['hits'])
+    METRICS.set('slicer_download_resolution_cache_misses_total', stats['misses'])
+
+    loader = app.config.get('_RECORDS_LOADER')
+    recordIndex = loader.recordIndex if loader is not None else None
+    if recordIndex is None:
+        return
+    METRICS.set('slicer_download_records', recordIndex.recordCount)
+    if recordIndex.lastModified is not None:
+        METRICS.set('slicer_download_snapshot_age_seconds', time.time() - recordIndex.lastModified)
+
+
+METRICS.addCollector(collectMetrics)
+
+
+@contextmanager
+def serverTiming(name):
+    """Add the time spent in the block to the ``name`` entry of the ``Server-Timing``
+    response header.
+
+    Nothing is measured unless the ``SERVER_TIMING`` configuration entry is set to
+    True and a request is being handled.
+    """
+    if not app.config.get('SERVER_TIMING', False) or not flask.has_request_context():
+        yield
+        return
+    startTime = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings = flask.g.setdefault('serverTimings', {})
+        timings[name] = timings.get(name, 0.0) + time.perf_counter() - startTime
+
+
+@app.before_request
+def startRequestTimer():
+    flask.g.requestStartTime = time.perf_counter()
+
+
+@app.after_request
+def recordRequestMetrics(response):
+    """Count the request and record its duration (see :const:`METRICS`)."""
+    startTime = flask.g.get('requestStartTime')
+    if startTime is not None:
+        route = flask.request.url_rule.rule if flask.request.url_rule is not None else 'unmatched'
+        METRICS.increment('slicer_download_requests_total', {
+            'route': route, 'method': flask.request.method, 'status': response.status_code})
+        METRICS.observe('slicer_download_request_duration_seconds', time.perf_counter() - startTime, {'route': route})
+    return response
+
+
+@app.after_request
+def addServerTimingHeader(response):
+    """Add ``Server-Timing`` header listing durations measured using :func:`serverTiming`
+    along with the total duration of the request."""
+    if not app.config.get('SERVER_TIMING', False):
+        return response
+    timings = dict(flask.g.get('serverTimings', {}))
+    startTime = flask.g.get('requestStartTime')
+    if startTime is not None:
+        timings['total'] = time.perf_counter() - startTime
+    response.headers['Server-Timing'] = ', '.join(
+        '{0};dur={1:.3f}'.format(name, duration * 1000) for name, duration in timings.items())
+    return response
+
+
+@app.route('/debug/profile')
+def profileRequest():
+    """Sample the stacks of the threads of the current process and render them
+    along with ``tracemalloc`` statistics.
+
+    The endpoint is only available if the ``DEBUG_TOKEN`` configuration entry is set
+    and matches the ``X-Debug-Token`` request header, the ``404`` page is rendered
+    otherwise.
+
+    Stacks are sampled for ``seconds`` seconds (default 5, at most
+    :const:`MAX_PROFILE_SECONDS`). If ``format`` is ``collapsed``, the collapsed stacks
+    are rendered as text, otherwise a JSON document also includes the memory allocated
+    by the server, mostly the records cache (see :func:`profiling.tracemallocStats`).
+    """
+    token = app.config.get('DEBUG_TOKEN')
+    requestToken = flask.request.headers.get('X-Debug-Token', '')
+    if not token or not hmac.compare_digest(requestToken.encode('utf-8'), token.encode('utf-8')):
+        flask.abort(404)
+
+    try:
+        seconds = float(flask.request.args.get('seconds', '5'))
+    except ValueError:
+        seconds = -1
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        error_message = 'bad seconds "{0}": should be a number in ]0, {1}]'.format(
+            flask.request.args.get('seconds'), MAX_PROFILE_SECONDS)
+        return flask.render_template('400.html', error_message=error_message), 400
+
+    samples, stacks = profiling.sampleStacks(seconds)
+    collapsed = profiling.formatCollapsedStacks(stacks)
+    if flask.request.args.get('format') == 'collapsed':
+        return app.response_class(collapsed, mimetype='text/plain')
+
+    return json.dumps({
+        'seconds': seconds,
+        'samples': samples,
+        'collapsed': collapsed,
+        'tracemalloc': profiling.tracemallocStats([app.root_path, os.path.dirname(slicer_download.__file__)])
+    })
+
+
+@app.route('/metrics')
+def metricsRequest():
+    """Render metrics using the Prometheus text exposition format.
+
+    If a metrics directory is set (see :func:`metricsDirPath`), the metrics of all
+    the processes sharing it are aggregated.
+
+    See :class:`slicer_download_server.metrics.Metrics`.
+    """
+    return app.response_class(METRICS.render(), mimetype='text/plain; version=0.0.4')
 
 
 @app.teardown_appcontext
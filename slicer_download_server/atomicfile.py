@@ -0,0 +1,32 @@
+"""Write files atomically.
+
+Files served or read by other processes (snapshots, metrics, exported pages) are
+first written into a temporary file of the same directory and then renamed, readers
+never see a partially written file.
+"""
+
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomicWrite(filepath, mode='w'):
+    """Return context manager yielding a file object opened with ``mode``.
+
+    The content is written into a temporary file renamed to ``filepath`` when the
+    block completes. The file is readable by all users, like files created with the
+    default umask. If an exception is raised, the temporary file is removed and
+    ``filepath`` is left unchanged.
+
+    Text files are encoded using UTF-8.
+    """
+    fd, tmp_filepath = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filepath)), suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode, encoding=None if 'b' in mode else 'utf-8') as fp:
+            yield fp
+        os.chmod(tmp_filepath, 0o644)
+        os.replace(tmp_filepath, filepath)
+    except BaseException:
+        os.unlink(tmp_filepath)
+        raise
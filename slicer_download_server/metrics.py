@@ -0,0 +1,202 @@
+"""Collect metrics and render them using the Prometheus text exposition format.
+
+Each process records its metrics in memory (see :class:`Metrics`). If a directory
+is specified, the metrics are also periodically written into ``<directory>/<pid>.json``
+so that the metrics of all the processes sharing the directory (e.g. uwsgi workers)
+are aggregated when rendered:
+
+* counters and histograms are summed, including the values written by processes
+  that exited since,
+
+* gauges are reported for each running process using a ``pid`` label.
+"""
+
+import glob
+import json
+import math
+import os
+import threading
+import time
+
+from .atomicfile import atomicWrite
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+# Upper bounds in seconds of the latency histogram buckets
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labelsKey(labels):
+    return tuple(sorted(labels.items())) if labels else ()
+
+
+def _isRunning(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _formatValue(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '{0}="{1}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in labels)
+
+
+class Metrics:
+    """Registry of counters, gauges and histograms.
+
+    Metrics are declared using :meth:`describe` and updated using :meth:`increment`,
+    :meth:`set` and :meth:`observe`. Functions registered using :meth:`addCollector`
+    are called before the metrics are written or rendered, they may be used to set
+    values maintained elsewhere.
+
+    If ``directory`` is set, the metrics of the current process are written at most
+    every ``flushInterval`` seconds by a background thread started on the first
+    update (see :meth:`flush`).
+    """
+
+    def __init__(self, directory=None, flushInterval=1.0):
+        self.directory = directory
+        self.flushInterval = flushInterval
+        self._descriptions = {}
+        self._values = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self._pid = None
+        self._dirty = False
+
+    def describe(self, name, kind, description, buckets=DEFAULT_BUCKETS):
+        """Declare metric ``name`` of type ``kind`` (``counter``, ``gauge`` or ``histogram``)."""
+        self._descriptions[name] = {'kind': kind, 'description': description, 'buckets': list(buckets)}
+
+    def addCollector(self, collector):
+        """Register function called without argument before metrics are written or rendered."""
+        self._collectors.append(collector)
+
+    def increment(self, name, labels=None, amount=1):
+        """Increment counter ``name`` by ``amount``."""
+        key = (name, _labelsKey(labels))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+            self._updated()
+
+    def set(self, name, value, labels=None):
+        """Set gauge or counter ``name`` to ``value``."""
+        with self._lock:
+            self._values[(name, _labelsKey(labels))] = value
+            self._updated()
+
+    def observe(self, name, value, labels=None):
+        """Add ``value`` to histogram ``name``."""
+        buckets = self._descriptions[name]['buckets']
+        key = (name, _labelsKey(labels))
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                # one count per bucket, then the +Inf bucket and the sum
+                counts = self._values[key] = [0] * (len(buckets) + 2)
+            index = 0
+            while index < len(buckets) and value > buckets[index]:
+                index += 1
+            counts[index] += 1
+            counts[-1] += value
+            self._updated()
+
+    def _updated(self):
+        self._dirty = True
+        if self.directory and self._pid != os.getpid():
+            # first update of this process, possibly forked after the metrics were created
+            self._pid = os.getpid()
+            threading.Thread(target=self._flushLoop, daemon=True).start()
+
+    def _flushLoop(self):
+        pid = os.getpid()
+        while self._pid == pid:
+            time.sleep(self.flushInterval)
+            if self._dirty:
+                self.flush()
+
+    def _state(self):
+        for collector in self._collectors:
+            collector()
+        with self._lock:
+            self._dirty = False
+            return [[name, [list(label) for label in labels], value if not isinstance(value, list) else list(value)]
+                    for (name, labels), value in self._values.items()]
+
+    def flush(self):
+        """Write metrics of the current process into ``<directory>/<pid>.json``."""
+        if not self.directory:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        with atomicWrite(os.path.join(self.directory, '{0}.json'.format(os.getpid()))) as fp:
+            json.dump(self._state(), fp)
+
+    def collect(self):
+        """Return dictionary mapping ``(name, labels)`` to values aggregated over all
+        the processes sharing ``directory``."""
+        if not self.directory:
+            return {(name, tuple(tuple(label) for label in labels)): value for name, labels, value in self._state()}
+
+        self.flush()
+        aggregated = {}
+        for filepath in glob.glob(os.path.join(self.directory, '*.json')):
+            pid = int(os.path.splitext(os.path.basename(filepath))[0])
+            try:
+                with open(filepath) as fp:
+                    state = json.load(fp)
+            except (OSError, ValueError):
+                continue
+            running = None
+            for name, labels, value in state:
+                labels = tuple(tuple(label) for label in labels)
+                kind = self._descriptions.get(name, {}).get('kind', GAUGE)
+                if kind == GAUGE:
+                    if running is None:
+                        running = _isRunning(pid)
+                    if running:
+                        aggregated[(name, labels + (('pid', pid),))] = value
+                elif kind == HISTOGRAM:
+                    previous = aggregated.get((name, labels), [0] * len(value))
+                    aggregated[(name, labels)] = [a + b for a, b in zip(previous, value)]
+                else:
+                    aggregated[(name, labels)] = aggregated.get((name, labels), 0) + value
+        return aggregated
+
+    def render(self):
+        """Return aggregated metrics formatted using the Prometheus text exposition format."""
+        values = self.collect()
+        lines = []
+        for name in sorted(self._descriptions):
+            description = self._descriptions[name]
+            samples = sorted((labels, value) for (sampleName, labels), value in values.items() if sampleName == name)
+            if not samples:
+                continue
+            lines.append('# HELP {0} {1}'.format(name, description['description']))
+            lines.append('# TYPE {0} {1}'.format(name, description['kind']))
+            for labels, value in samples:
+                if description['kind'] != HISTOGRAM:
+                    lines.append('{0}{1} {2}'.format(name, _formatLabels(labels), _formatValue(value)))
+                    continue
+                cumulative = 0
+                for bound, count in zip(description['buckets'] + [math.inf], value[:-1]):
+                    cumulative += count
+                    lines.append('{0}_bucket{1} {2}'.format(
+                        name, _formatLabels(labels + (('le', _formatValue(bound)),)), cumulative))
+                lines.append('{0}_sum{1} {2}'.format(name, _formatLabels(labels), _formatValue(value[-1])))
+                lines.append('{0}_count{1} {2}'.format(name, _formatLabels(labels), cumulative))
+        return '\n'.join(lines) + '\n'
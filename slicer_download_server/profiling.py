@@ -0,0 +1,74 @@
+"""Sample the stacks of the running threads and summarize memory allocations.
+
+The stacks are reported using the "collapsed" format expected by flame graph
+tools (e.g. ``flamegraph.pl``): one line per distinct stack, made of the frames
+separated by ``;`` from the outermost to the innermost, followed by the number
+of samples.
+"""
+
+import collections
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+
+def _frameName(frame):
+    code = frame.f_code
+    directory, filename = os.path.split(code.co_filename)
+    return '{0}/{1}:{2}'.format(os.path.basename(directory), filename, code.co_name)
+
+
+def sampleStacks(duration, interval=0.005):
+    """Sample the stacks of all the threads except the calling one during ``duration``
+    seconds and return the number of samples and a dictionary mapping collapsed
+    stacks to their number of occurrences."""
+    currentThreadId = threading.get_ident()
+    stacks = collections.Counter()
+    samples = 0
+    endTime = time.monotonic() + duration
+    while time.monotonic() < endTime:
+        for threadId, frame in sys._current_frames().items():
+            if threadId == currentThreadId:
+                continue
+            names = []
+            while frame is not None:
+                names.append(_frameName(frame))
+                frame = frame.f_back
+            stacks[';'.join(reversed(names))] += 1
+        samples += 1
+        time.sleep(interval)
+    return samples, stacks
+
+
+def formatCollapsedStacks(stacks):
+    """Return ``stacks`` returned by :func:`sampleStacks` using the collapsed format."""
+    return ''.join('{0} {1}\n'.format(stack, count) for stack, count in sorted(stacks.items()))
+
+
+def tracemallocStats(directories, limit=20):
+    """Return dictionary summarizing the memory allocated from code found in ``directories``.
+
+    If ``tracemalloc`` is not tracing, an empty dictionary is returned. Tracing all
+    the allocations done since startup requires setting the ``PYTHONTRACEMALLOC``
+    environment variable (e.g. ``PYTHONTRACEMALLOC=25``).
+    """
+    if not tracemalloc.is_tracing():
+        return {}
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(True, os.path.join(directory, '*'), all_frames=True) for directory in directories])
+    statistics = snapshot.statistics('lineno')
+    return {
+        'traceback_limit': tracemalloc.get_traceback_limit(),
+        'total_size': sum(stat.size for stat in statistics),
+        'total_count': sum(stat.count for stat in statistics),
+        'top': [
+            {
+                'location': '{0}:{1}'.format(stat.traceback[0].filename, stat.traceback[0].lineno),
+                'size': stat.size,
+                'count': stat.count
+            }
+            for stat in statistics[:limit]
+        ]
+    }
@@ -0,0 +1,130 @@
+"""Read and write record snapshot files.
+
+A snapshot file stores a JSON header followed by named sections. Each section is
+either an array of 64-bit integers or a table of strings. Sections are memory mapped
+when the file is read, allowing multiple processes to share a single physical copy.
+
+File layout::
+
+    +--------------------+---------------------------+--------------+-----+
+    | MAGIC (8 bytes)    | header size (8 bytes)     | header JSON  | ... |
+    +--------------------+---------------------------+--------------+-----+
+
+A string table is stored as an array of ``count + 1`` offsets followed by the
+concatenated UTF-8 encoded strings. All sections start on a 8-byte boundary.
+"""
+
+import array
+import json
+import mmap
+import struct
+import sys
+
+from .atomicfile import atomicWrite
+
+MAGIC = b'SDSNAP01'
+
+FORMAT_VERSION = 1
+
+_SIZE = struct.Struct('=q')
+
+_ALIGNMENT = 8
+
+
+class StringTable:
+    """Read-only sequence of strings backed by memory mapped offsets and data."""
+
+    def __init__(self, offsets, data):
+        self._offsets = offsets
+        self._data = data
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('string table index out of range')
+        return str(self._data[self._offsets[index]:self._offsets[index + 1]], 'utf-8')
+
+
+def _padding(size):
+    return (_ALIGNMENT - size % _ALIGNMENT) % _ALIGNMENT
+
+
+def _encodeSection(values):
+    """Return kind and encoded chunks associated with ``values``."""
+    if values and isinstance(values[0], str):
+        encoded = [value.encode('utf-8') for value in values]
+        offsets = array.array('q', [0])
+        for value in encoded:
+            offsets.append(offsets[-1] + len(value))
+        return 'str', [offsets.tobytes()] + encoded
+    return 'int', [array.array('q', values).tobytes()]
+
+
+def writeSnapshot(filepath, header, sections):
+    """Write ``header`` and ``sections`` into snapshot file ``filepath``.
+
+    ``header`` is a JSON serializable dictionary. ``sections`` maps section names to
+    lists of integers or lists of strings.
+
+    The snapshot is first written to a temporary file in the same directory and
+    then atomically renamed, processes reading the previous file are not affected.
+    """
+    layout = {}
+    chunks = []
+    offset = 0
+    for name, values in sections.items():
+        kind, encoded = _encodeSection(values)
+        size = sum(len(chunk) for chunk in encoded)
+        layout[name] = {'kind': kind, 'offset': offset, 'size': size, 'count': len(values)}
+        chunks.extend(encoded)
+        chunks.append(b'\0' * _padding(size))
+        offset += size + _padding(size)
+
+    header = dict(header, format=FORMAT_VERSION, byteorder=sys.byteorder, sections=layout)
+    encodedHeader = json.dumps(header).encode('utf-8')
+    encodedHeader += b' ' * _padding(len(MAGIC) + _SIZE.size + len(encodedHeader))
+
+    with atomicWrite(filepath, 'wb') as fp:
+        fp.write(MAGIC)
+        fp.write(_SIZE.pack(len(encodedHeader)))
+        fp.write(encodedHeader)
+        for chunk in chunks:
+            fp.write(chunk)
+
+
+def readSnapshot(filepath):
+    """Return header and sections read from snapshot file ``filepath``.
+
+    Sections are returned as a dictionary mapping names to read-only sequences
+    referencing the memory mapped file: integer arrays are ``memoryview`` objects
+    and string tables are :class:`StringTable` objects.
+
+    Raise :class:`ValueError` if the file is not a valid snapshot.
+    """
+    with open(filepath, 'rb') as fp:
+        mapped = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    view = memoryview(mapped)
+    start = len(MAGIC) + _SIZE.size
+    if len(view) < start or view[:len(MAGIC)] != MAGIC:
+        raise ValueError('%s is not a snapshot file' % filepath)
+    headerSize, = _SIZE.unpack(view[len(MAGIC):start])
+    header = json.loads(str(view[start:start + headerSize], 'utf-8'))
+    if header.get('format') != FORMAT_VERSION or header.get('byteorder') != sys.byteorder:
+        raise ValueError('%s has an unsupported snapshot format' % filepath)
+
+    dataStart = start + headerSize
+    sections = {}
+    for name, section in header['sections'].items():
+        offset = dataStart + section['offset']
+        if section['kind'] == 'str':
+            offsetsSize = (section['count'] + 1) * _SIZE.size
+            offsets = view[offset:offset + offsetsSize].cast('q')
+            sections[name] = StringTable(offsets, view[offset + offsetsSize:offset + section['size']])
+        else:
+            sections[name] = view[offset:offset + section['size']].cast('q')
+    return header, sections
@@ -0,0 +1,284 @@
+"""Test downloading package metadata from a local stand-in for the server APIs.
+
+Run using ``python -m unittest discover tests`` from the repository root.
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import runpy
+import sqlite3
+import sys
+import threading
+import unittest
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_DIR)
+
+import slicer_download  # noqa: E402
+
+
+def girderRecord(index, created):
+    return {
+        '_id': '%024x' % index,
+        'name': 'Slicer-4.11.{0}-linux'.format(index),
+        'size': 1000 + index,
+        'created': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'meta': {
+            'os': 'linux', 'arch': 'amd64', 'revision': str(20000 + index),
+            'build_date': created.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'baseName': 'Slicer', 'version': '4.11.{0}'.format(index)
+        }
+    }
+
+
+def midasRecord(index, created):
+    return {
+        'item_id': str(index), 'revision': str(20000 + index),
+        'checkoutdate': created.strftime('%Y-%m-%d %H:%M:%S'),
+        'date_creation': created.strftime('%Y-%m-%d %H:%M:%S'),
+        'os': 'linux', 'arch': 'amd64', 'codebase': 'Slicer4', 'package': 'installer',
+        'productname': 'Slicer', 'release': '', 'submissiontype': 'nightly',
+        'name': 'Slicer-4.11.{0}-linux-amd64'.format(index),
+        'bitstreams': [{'bitstream_id': str(index * 10), 'size': 1000 + index, 'md5': '0' * 32, 'name': 'a.tar.gz'}]
+    }
+
+
+class StandInServer:
+    """HTTP server answering the requests sent by :func:`slicer_download.iterRecordsFromURL`.
+
+    Girder records are returned by pages sorted by decreasing creation date, Midas
+    records are returned at once. Each response has an ``ETag`` computed from its
+    content and requests with a matching ``If-None-Match`` header are answered with
+    ``304 Not Modified``.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.requests = []
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                server.requests.append((self.path, self.headers.get('If-None-Match')))
+                query = dict(urllib.parse.parse_qsl(urllib.parse.urlparse(self.path).query))
+                if 'method' in query:
+                    body = {'data': server.records}
+                else:
+                    records = sorted(server.records, key=lambda record: record['created'], reverse=True)
+                    offset, limit = int(query['offset']), int(query['limit'])
+                    body = records[offset:offset + limit]
+                data = json.dumps(body).encode('utf-8')
+                etag = '"{0}"'.format(hashlib.sha1(data).hexdigest())
+                if self.headers.get('If-None-Match') == etag:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:{0}'.format(self.httpd.server_port)
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FetchTestCase(unittest.TestCase):
+
+    serverAPI = None
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.addCleanup(self.server.close)
+        for patcher in (
+                mock.patch.dict(os.environ, {'SLICER_DOWNLOAD_SERVER_API': self.serverAPI}),
+                mock.patch.object(slicer_download, 'getServerAPIUrl', lambda: self.server.url)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class GirderFetchTest(FetchTestCase):
+
+    serverAPI = 'Girder_v1'
+
+    def setUp(self):
+        super().setUp()
+        start = datetime.datetime(2021, 1, 1)
+        self.server.records = [girderRecord(index, start + datetime.timedelta(hours=index)) for index in range(45)]
+        patcher = mock.patch.object(slicer_download, 'FETCH_PAGE_SIZE', 10)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_pagination(self):
+        records = list(slicer_download.iterRecordsFromURL())
+        self.assertEqual([record['_id'] for record in records],
+                         ['%024x' % index for index in reversed(range(45))])
+        offsets = sorted(int(dict(urllib.parse.parse_qsl(urllib.parse.urlparse(path).query))['offset'])
+                         for path, _ in self.server.requests)
+        self.assertEqual(offsets, [0, 10, 20, 30, 40])
+
+    def test_newer_than(self):
+        newerThan = self.server.records[33]['created']
+        records = list(slicer_download.iterRecordsFromURL(newerThan=newerThan))
+        self.assertEqual([record['_id'] for record in records],
+                         ['%024x' % index for index in reversed(range(33, 45))])
+        # the page including older records is the last one requested
+        self.assertEqual(len(self.server.requests), 1 + slicer_download.FETCH_WORKERS)
+
+        # dates may be shortened, e.g. to the day (see slicer_getbuildinfo)
+        records = list(slicer_download.iterRecordsFromURL(newerThan='2021-01-02'))
+        self.assertEqual(len(records), 45 - 24)
+
+    def test_not_modified(self):
+        validators = {}
+        self.assertEqual(len(list(slicer_download.iterRecordsFromURL(validators=validators))), 45)
+        self.assertEqual(len(validators), 1)
+
+        del self.server.requests[:]
+        self.assertEqual(list(slicer_download.iterRecordsFromURL(validators=validators)), [])
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertIsNotNone(self.server.requests[0][1])
+
+        self.server.records.append(girderRecord(45, datetime.datetime(2021, 2, 1)))
+        records = list(slicer_download.iterRecordsFromURL(validators=validators))
+        self.assertEqual(len(records), 46)
+
+
+class MidasFetchTest(FetchTestCase):
+
+    serverAPI = 'Midas_v1'
+
+    def setUp(self):
+        super().setUp()
+        start = datetime.datetime(2021, 1, 1)
+        self.server.records = [midasRecord(index, start + datetime.timedelta(hours=index)) for index in range(30)]
+
+    def test_newer_than(self):
+        records = list(slicer_download.iterRecordsFromURL(newerThan='2021-01-01 20:00:00'))
+        self.assertEqual([record['item_id'] for record in records], [str(index) for index in range(20, 30)])
+
+    def test_not_modified(self):
+        validators = {}
+        self.assertEqual(len(list(slicer_download.iterRecordsFromURL(validators=validators))), 30)
+        self.assertEqual(list(slicer_download.iterRecordsFromURL(validators=validators)), [])
+        self.assertIsNotNone(self.server.requests[-1][1])
+
+
+class StreamedResponse:
+    """Stand-in for a streamed ``requests`` response whose content is ``document``."""
+
+    def __init__(self, document):
+        self.content = document.encode('utf-8')
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.content), chunk_size):
+            yield self.content[start:start + chunk_size]
+
+
+class JSONArrayTest(unittest.TestCase):
+
+    def iterJSONArray(self, document, chunkSize, key='data'):
+        with mock.patch.object(slicer_download, 'STREAM_CHUNK_SIZE', chunkSize):
+            return list(slicer_download.iterJSONArray(StreamedResponse(document), key))
+
+    def assertArrayParsed(self, document, key='data'):
+        expected = json.loads(document)[key]
+        for chunkSize in range(1, len(document.encode('utf-8')) + 2):
+            self.assertEqual(self.iterJSONArray(document, chunkSize, key), expected, chunkSize)
+
+    def test_split_items(self):
+        records = [midasRecord(index, datetime.datetime(2021, 1, 1)) for index in range(3)]
+        records[1]['name'] = 'Slicer-été-☃'
+        self.assertArrayParsed(json.dumps({'stat': 'ok', 'data': records}))
+        self.assertArrayParsed(json.dumps({'data': [123, -4.5e6, True, None, 'abc', [1, [2]], {}]}))
+        self.assertArrayParsed('{"data":[1,22 ,333\n]}')
+
+    def test_separators_in_strings(self):
+        self.assertArrayParsed(json.dumps({'data': [{'name': 'a], [b'}, '], ', ',', ']', 'x"]"y']}))
+
+    def test_key_repeated(self):
+        self.assertArrayParsed(json.dumps({'message': 'no "data" here', 'data': [{'data': []}, 1]}))
+
+    def test_empty_array(self):
+        self.assertArrayParsed('{"data": []}')
+        self.assertArrayParsed('{"data": [ \n ], "stat": "ok"}')
+
+    def test_malformed(self):
+        for document in (
+                '',
+                '{"stat": "ok"}',
+                '{"data": [{"a": 1}, {"b"',
+                '{"data": [{"a": 1}, 2',
+                '{"data": [1, 2,',
+                '{"data": [1, }]}',
+                '{"data": [1, nope]}'):
+            for chunkSize in (1, 4, 1024):
+                with self.assertRaises(ValueError, msg=(document, chunkSize)):
+                    self.iterJSONArray(document, chunkSize)
+
+
+class GetBuildInfoTest(FetchTestCase):
+
+    serverAPI = 'Girder_v1'
+
+    def setUp(self):
+        super().setUp()
+        self.getbuildinfo = runpy.run_path(os.path.join(ROOT_DIR, 'etc', 'slicer_getbuildinfo', '__main__.py'))
+        self.db = sqlite3.connect(':memory:')
+        self.addCleanup(self.db.close)
+
+    def updateDb(self, full=False):
+        return self.getbuildinfo['updateDb'](
+            self.db, slicer_download.getServerAPIAdapter(), 'TEXT', full)
+
+    def count(self):
+        return self.db.execute('select count(1) from _').fetchone()[0]
+
+    def test_late_listed_records(self):
+        start = datetime.datetime(2021, 1, 1)
+        self.server.records = [girderRecord(index, start + datetime.timedelta(hours=index)) for index in range(1000)]
+        self.assertEqual(self.updateDb(), (1000, True))
+
+        # records created before the newest stored one but listed after the last update
+        newest = start + datetime.timedelta(hours=999)
+        self.server.records += [
+            girderRecord(index, newest - datetime.timedelta(days=1) + datetime.timedelta(minutes=5 * (index - 1000)))
+            for index in range(1000, 1450)]
+        del self.server.requests[:]
+        changed, full = self.updateDb()
+        self.assertFalse(full)
+        self.assertEqual(changed, 450)
+        self.assertEqual(self.count(), 1450)
+        self.assertLess(len(self.server.requests), 1450 // slicer_download.FETCH_PAGE_SIZE)
+
+    def test_modified_records(self):
+        start = datetime.datetime(2021, 1, 1)
+        self.server.records = [girderRecord(index, start + datetime.timedelta(days=index)) for index in range(100)]
+        self.updateDb()
+
+        self.server.records[0]['size'] = 1
+        self.assertEqual(self.updateDb(), (0, False))
+
+        # records modified upstream are updated by the next full update
+        self.db.execute("update full_update set date = datetime('now', '-2 days')")
+        self.assertEqual(self.updateDb(), (1, True))
+        record = json.loads(self.db.execute('select record from _ where item_id = ?', ['%024x' % 0]).fetchone()[0])
+        self.assertEqual(record['size'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
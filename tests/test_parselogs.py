@@ -0,0 +1,115 @@
+"""Test resuming the parsing of apache logs from the checkpoints stored by slicer_parselogs.
+
+Run using ``python -m unittest discover tests`` from the repository root.
+"""
+
+import contextlib
+import gzip
+import io
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, 'etc'))
+
+from slicer_parselogs import access  # noqa: E402
+
+
+def log_line(index):
+    """Return apache log line of the ``index``-th download of a Girder bitstream."""
+    return ('10.0.0.{0} - - [01/Sep/2021:06:05:{1:02d} +0000] "GET /bitstream/{2:024x} HTTP/1.1" '
+            '200 1234 "-" "Mozilla/5.0"\n').format(index % 256, index % 60, index)
+
+
+class CheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.logdir = tmpdir.name
+        patcher = mock.patch.dict(os.environ, {'SLICER_DOWNLOAD_SERVER_API': 'Girder_v1'})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.db = sqlite3.connect(':memory:')
+        self.addCleanup(self.db.close)
+        with contextlib.redirect_stdout(io.StringIO()):
+            access.create_access_table(self.db)
+
+    def write_log(self, filename, indices, mode='a', partial=''):
+        with open(os.path.join(self.logdir, filename), mode) as fp:
+            fp.write(''.join(log_line(index) for index in indices) + partial)
+
+    def parse(self, *filenames):
+        """Parse ``filenames`` and return the offsets each file was read from."""
+        with mock.patch.object(access, 'read_and_parse', wraps=access.read_and_parse) as read_and_parse:
+            with contextlib.redirect_stdout(io.StringIO()):
+                access.add_access_info(self.db, [os.path.join(self.logdir, filename) for filename in filenames])
+        return {os.path.basename(call.args[0]): call.args[1] for call in read_and_parse.call_args_list}
+
+    def accessed_bitstreams(self):
+        return sorted(int(row[0], 16) for row in self.db.execute('select bitstream_id from access'))
+
+    def test_appended_lines(self):
+        self.write_log('access.log', range(3))
+        self.assertEqual(self.parse('access.log'), {'access.log': 0})
+        parsed_size = os.path.getsize(os.path.join(self.logdir, 'access.log'))
+
+        # the last line is still being written
+        self.write_log('access.log', range(3, 5), partial=log_line(5)[:20])
+        self.assertEqual(self.parse('access.log'), {'access.log': parsed_size})
+        self.assertEqual(self.accessed_bitstreams(), list(range(5)))
+
+        self.write_log('access.log', [], partial=log_line(5)[20:])
+        self.assertEqual(self.parse('access.log'), {'access.log': parsed_size + len(log_line(3) + log_line(4))})
+        self.assertEqual(self.accessed_bitstreams(), list(range(6)))
+
+        # nothing new
+        self.assertEqual(self.parse('access.log'), {})
+
+    def test_rotated_log(self):
+        self.write_log('access.log', range(3))
+        self.parse('access.log')
+        parsed_size = os.path.getsize(os.path.join(self.logdir, 'access.log'))
+
+        # lines written before the rotation are found in the renamed log, the new
+        # log has a different first line
+        self.write_log('access.log', [3])
+        os.rename(os.path.join(self.logdir, 'access.log'), os.path.join(self.logdir, 'access.log.1'))
+        self.write_log('access.log', range(4, 6))
+        self.assertEqual(self.parse('access.log.1', 'access.log'), {'access.log.1': parsed_size, 'access.log': 0})
+        self.assertEqual(self.accessed_bitstreams(), list(range(6)))
+
+        # the compressed log has the same first line, its content was already parsed
+        with open(os.path.join(self.logdir, 'access.log.1'), 'rb') as src:
+            with gzip.open(os.path.join(self.logdir, 'access.log.1.gz'), 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        os.unlink(os.path.join(self.logdir, 'access.log.1'))
+        self.assertEqual(self.parse('access.log.1.gz'), {'access.log.1.gz': parsed_size + len(log_line(3))})
+
+        # compressed logs are complete
+        self.assertEqual(self.parse('access.log.1.gz', 'access.log'), {})
+        self.assertEqual(self.accessed_bitstreams(), list(range(6)))
+
+    def test_truncated_log(self):
+        self.write_log('access.log', range(3))
+        self.parse('access.log')
+
+        # written again with the same first line: the checkpoint is past the end of the file
+        self.write_log('access.log', [0, 3], mode='w')
+        self.assertEqual(self.parse('access.log'), {'access.log': 0})
+        self.assertEqual(self.accessed_bitstreams(), list(range(4)))
+
+        # written again with a new first line
+        self.write_log('access.log', [4], mode='w')
+        self.assertEqual(self.parse('access.log'), {'access.log': 0})
+        self.assertEqual(self.accessed_bitstreams(), list(range(5)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,265 @@
+"""Test the server endpoints answering queries from records stored by slicer_getbuildinfo.
+
+Run using ``python -m unittest discover tests`` from the repository root.
+"""
+
+import contextlib
+import datetime
+import gzip
+import io
+import json
+import os
+import runpy
+import sqlite3
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+ROOT_DIR = os.path.realpath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT_DIR)
+
+# The server API is read once when the server module is imported
+os.environ['SLICER_DOWNLOAD_SERVER_API'] = 'Girder_v1'
+os.environ.setdefault('SLICER_DOWNLOAD_SERVER_CONF', os.path.join(ROOT_DIR, 'etc', 'conf', 'config.py'))
+
+import slicer_download  # noqa: E402
+import slicer_download_server  # noqa: E402
+
+FIRST_DAY = datetime.datetime(2021, 1, 1)
+
+OPERATING_SYSTEMS = ('win', 'macosx', 'linux')
+
+
+def packageRecord(index, release=''):
+    """Return Girder record of the ``index``-th package.
+
+    Packages are built every day for each operating system, the revision is
+    incremented every day.
+    """
+    day, position = divmod(index, len(OPERATING_SYSTEMS))
+    created = (FIRST_DAY + datetime.timedelta(days=day, minutes=position)).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+    meta = {
+        'os': OPERATING_SYSTEMS[position], 'arch': 'amd64', 'revision': str(30000 + day),
+        'build_date': created, 'baseName': 'Slicer',
+        'version': '{0}-{1}'.format(release or '5.1.0', created[:10])
+    }
+    if release:
+        meta['release'] = release
+    return {'_id': '%024x' % index, 'name': 'Slicer-{0}-{1}'.format(meta['version'], meta['os']),
+            'size': 100000 + index, 'created': created, 'meta': meta}
+
+
+def parsingJSONRecords():
+    """Return patcher loading records from the JSON documents of the ``_`` table
+    instead of the normalized ``packages`` table."""
+    return mock.patch.object(slicer_download_server.RecordsLoader, '_recordSource', staticmethod(
+        lambda database_connection: ('_', slicer_download_server.SERVER_API_ADAPTER)))
+
+
+class ServerTestCase(unittest.TestCase):
+    """Serve records written into a temporary database using ``slicer_getbuildinfo``."""
+
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dbfile = os.path.join(tmpdir.name, 'records.sqlite')
+        self.downloadedRecords = []
+
+        for patcher in (
+                mock.patch.dict(slicer_download_server.app.config, {'DB_FILE': self.dbfile}),
+                mock.patch.object(slicer_download, 'iterRecordsFromURL',
+                                  lambda newerThan=None, validators=None: iter(self.downloadedRecords))):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.getbuildinfo = runpy.run_path(os.path.join(ROOT_DIR, 'etc', 'slicer_getbuildinfo', '__main__.py'))
+        self.client = slicer_download_server.app.test_client()
+
+    def writeRecords(self, records):
+        """Store ``records`` as if they were downloaded by ``slicer_getbuildinfo``."""
+        self.downloadedRecords = records
+        db = sqlite3.connect(self.dbfile)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.getbuildinfo['updateDb'](db, slicer_download.getServerAPIAdapter(), 'TEXT', True)
+        finally:
+            db.close()
+
+
+class RenderedResponseTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writeRecords([packageRecord(index, release='5.0.{0}'.format(index) if index % 10 == 0 else '')
+                           for index in range(30)])
+
+    def test_gzip(self):
+        response = self.client.get('/findall', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers.get('Content-Encoding'), 'gzip')
+        self.assertIn('linux', json.loads(gzip.decompress(response.data)))
+
+    def test_gzip_refused(self):
+        for acceptEncoding in ('gzip;q=0', 'identity', None):
+            headers = {'Accept-Encoding': acceptEncoding} if acceptEncoding else {}
+            response = self.client.get('/findall', headers=headers)
+            self.assertIsNone(response.headers.get('Content-Encoding'), acceptEncoding)
+            self.assertIn('linux', json.loads(response.data))
+
+    def test_not_modified(self):
+        response = self.client.get('/findall')
+        response = self.client.get('/findall', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+
+class BadRequestTest(ServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.writeRecords([packageRecord(index) for index in range(30)])
+
+    def test_bad_offset(self):
+        for url in ('/find?os=linux&offset=abc', '/download?os=linux&offset=abc',
+                    '/findall?offset=abc', '/?offset=abc'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 400, url)
+            self.assertIn(b'bad offset', response.data, url)
+
+    def test_bad_revision(self):
+        for url in ('/find?os=linux&revision=abc', '/findall?revision=abc', '/?revision=abc'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 400, url)
+
+    def test_batch_bad_offset(self):
+        queries = [{'os': 'linux', 'offset': 'abc'}, {'os': 'linux', 'stability': 'nightly'}]
+        response = self.client.post('/findbatch', json=queries)
+        self.assertEqual([result['status'] for result in json.loads(response.data)], [400, 200])
+
+
+class RecordsLoaderTest(ServerTestCase):
+    """Check that the index updated with the changed rows matches the index of all
+    the records, and that only the keys of the changed rows are computed."""
+
+    def setUp(self):
+        super().setUp()
+        self.records = [packageRecord(index, release='5.0.{0}'.format(index) if index % 10 == 0 else '')
+                        for index in range(60)]
+        self.writeRecords(self.records)
+        self.loader = slicer_download_server.RecordsLoader(self.dbfile)
+        recordIndex = self.loader.getRecordIndex()
+        for position in range(recordIndex.recordCount):
+            recordIndex.cleanedRecord(position)
+
+    def assertIndexUpdated(self, computedKeys):
+        with mock.patch.object(slicer_download_server, 'recordIndexKeys',
+                               wraps=slicer_download_server.recordIndexKeys) as recordIndexKeys:
+            recordIndex = self.loader.getRecordIndex()
+        self.assertEqual(recordIndexKeys.call_count, computedKeys)
+
+        expected = slicer_download_server.RecordsLoader(self.dbfile).getRecordIndex()
+        for attribute in ('records', 'recordKeys', 'revisions', 'osTables', 'buckets'):
+            self.assertEqual(getattr(recordIndex, attribute), getattr(expected, attribute), attribute)
+        self.assertEqual([recordIndex.cleanedRecord(position) for position in range(recordIndex.recordCount)],
+                         [expected.cleanedRecord(position) for position in range(expected.recordCount)])
+        return recordIndex
+
+    def deleteRecords(self, itemIds):
+        db = sqlite3.connect(self.dbfile)
+        try:
+            with db:
+                for table in ('_', 'packages'):
+                    db.executemany('delete from {0} where item_id = ?'.format(table), [[itemId] for itemId in itemIds])
+        finally:
+            db.close()
+
+    def test_append(self):
+        self.writeRecords(self.records + [packageRecord(index) for index in range(60, 64)])
+        recordIndex = self.assertIndexUpdated(computedKeys=4)
+        self.assertEqual(recordIndex.recordCount, 64)
+
+    def test_append_same_revision(self):
+        record = packageRecord(62)
+        record['meta']['revision'] = self.records[59]['meta']['revision']
+        self.writeRecords(self.records + [record])
+        recordIndex = self.assertIndexUpdated(computedKeys=1)
+        osTable = recordIndex.osTables['linux']
+        self.assertEqual(osTable['groupLast'][0] - osTable['groupFirst'][0], 1)
+
+    def test_append_older(self):
+        record = packageRecord(0)
+        record['_id'] = 'f' * 24
+        record['meta']['revision'] = '29999'
+        self.writeRecords(self.records + [record])
+        self.assertIndexUpdated(computedKeys=1)
+
+    def test_update_in_place(self):
+        self.records[10]['size'] += 1
+        self.records[20]['meta']['arch'] = 'arm64'
+        self.writeRecords(self.records)
+        self.assertIndexUpdated(computedKeys=2)
+
+    def test_update_keys(self):
+        self.records[10]['meta']['release'] = '5.0.99'
+        self.writeRecords(self.records)
+        self.assertIndexUpdated(computedKeys=1)
+
+    def test_delete(self):
+        self.deleteRecords([self.records[10]['_id'], self.records[59]['_id']])
+        recordIndex = self.assertIndexUpdated(computedKeys=0)
+        self.assertEqual(recordIndex.recordCount, 58)
+
+    def test_unchanged(self):
+        self.writeRecords(self.records)
+        self.assertIndexUpdated(computedKeys=0)
+
+    def test_pruned_change_log(self):
+        with mock.patch.dict(self.getbuildinfo['pruneChangeLog'].__globals__, {'CHANGE_LOG_SIZE': 1}):
+            self.writeRecords(self.records + [packageRecord(60), packageRecord(61)])
+        self.assertIndexUpdated(computedKeys=62)
+
+
+class JSONRecordsLoaderTest(RecordsLoaderTest):
+    """Same as :class:`RecordsLoaderTest` with records parsed from the ``_`` table."""
+
+    def setUp(self):
+        patcher = parsingJSONRecords()
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        super().setUp()
+
+
+class NormalizedTableTest(ServerTestCase):
+    """Check that records read from the normalized ``packages`` table are served like
+    the ones parsed from the JSON documents."""
+
+    URLS = (
+        '/findall',
+        '/find?os=linux&stability=nightly&offset=-2',
+        '/find?os=macosx&version=5.0.10',
+        '/find?os=macosx&stability=nightly&revision=30001'
+    )
+
+    def setUp(self):
+        super().setUp()
+        records = [packageRecord(index, release='5.0.{0}'.format(index) if index % 10 == 0 else '')
+                   for index in range(30)]
+        # sizes are strings in Midas records
+        records[4]['size'] = str(records[4]['size'])
+        self.writeRecords(records)
+
+    def getResponses(self):
+        slicer_download_server.app.config.pop('_RECORDS_LOADER', None)
+        responses = [json.loads(self.client.get(url).data) for url in self.URLS]
+        return slicer_download_server.app.config['_RECORDS_LOADER']._loadedRows['table'], responses
+
+    def test_same_responses(self):
+        table, normalized = self.getResponses()
+        self.assertEqual(table, 'packages')
+        with parsingJSONRecords():
+            table, parsed = self.getResponses()
+        self.assertEqual(table, '_')
+        self.assertEqual(normalized, parsed)
+        self.assertEqual(normalized[-1]['size'], '100004')
+
+
+if __name__ == '__main__':
+    unittest.main()